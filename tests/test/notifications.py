@@ -0,0 +1,7 @@
+from transmissions import message
+from transmissions.channels.email import DefaultEmailMessage
+
+
+@message('autodiscovered', behavior=None, subject='Hello World!')
+class AutodiscoveredMessage(DefaultEmailMessage):
+    template_name = 'test'
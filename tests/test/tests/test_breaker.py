@@ -0,0 +1,184 @@
+import logging
+
+import mock
+from django.core import mail
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils import timezone
+
+from transmissions import message
+from transmissions.breaker import CircuitBreaker
+from transmissions.channels.email import DefaultEmailMessage
+from transmissions.exceptions import ChannelSendException
+from transmissions.models import Notification
+from . import factories
+
+
+class ProviderMessage(DefaultEmailMessage):
+    down = False
+
+    def send(self):
+        if ProviderMessage.down:
+            raise ChannelSendException('Provider is down')
+        super(ProviderMessage, self).send()
+
+
+@message('breaker_test', behavior=None, subject='Hello World!')
+class BreakerMessage(ProviderMessage):
+    template_name = 'test'
+
+
+@message('breaker_test_other', behavior=None, subject='Hello World!')
+class OtherBreakerMessage(ProviderMessage):
+    template_name = 'test'
+
+
+class BreakerTests(TestCase):
+
+    def setUp(self):
+        logging.disable(logging.WARNING)
+        cache.clear()
+        ProviderMessage.down = False
+        self.addCleanup(setattr, ProviderMessage, 'down', False)
+
+    def test_provider(self):
+
+        self.assertEqual(CircuitBreaker.provider_of(BreakerMessage), '{}.ProviderMessage'.format(__name__))
+        self.assertEqual(CircuitBreaker.provider_of(DefaultEmailMessage),
+                         'transmissions.channels.email.DefaultEmailMessage')
+        with mock.patch.object(BreakerMessage, 'provider', 'twilio', create=True):
+            self.assertEqual(CircuitBreaker.provider_of(BreakerMessage), 'twilio')
+
+    def test_states(self):
+
+        with self.settings(TRANSMISSIONS_CIRCUIT_FAILURES=2):
+            breaker = CircuitBreaker('states')
+            self.assertTrue(breaker.allow())
+            self.assertIsNone(breaker.failure())
+            self.assertIsNotNone(breaker.failure())
+
+            # Open
+            self.assertFalse(CircuitBreaker('states').allow())
+
+            # Half-open, a single probe is allowed
+            cache.delete('transmissions-circuit-states-open')
+            probe = CircuitBreaker('states')
+            self.assertTrue(probe.allow())
+            self.assertTrue(probe.probing)
+            self.assertFalse(CircuitBreaker('states').allow())
+
+            # Probe failed
+            self.assertIsNotNone(probe.failure())
+            self.assertFalse(CircuitBreaker('states').allow())
+
+            # Probe succeeded
+            cache.delete('transmissions-circuit-states-open')
+            probe = CircuitBreaker('states')
+            self.assertTrue(probe.allow())
+            probe.success()
+            breaker = CircuitBreaker('states')
+            self.assertTrue(breaker.allow())
+            self.assertFalse(breaker.probing)
+
+    def test_send_many_opens(self):
+
+        users = [factories.User() for i in range(5)]
+        notifications = [BreakerMessage.trigger(user) for user in users]
+        pending = OtherBreakerMessage.trigger(users[0])
+
+        ProviderMessage.down = True
+        with self.settings(TRANSMISSIONS_CIRCUIT_FAILURES=2, TRANSMISSIONS_CIRCUIT_RESET_SECONDS=60):
+            Notification.send_many(notifications)
+
+            # Failed notifications are retried, the others were not sent
+            notifications = [Notification.objects.get(pk=notification.pk) for notification in notifications]
+            self.assertEqual([notification.status for notification in notifications],
+                             [Notification.Status.CREATED] * 5)
+            self.assertEqual([notification.attempts for notification in notifications], [1, 1, 0, 0, 0])
+
+            # Pending notifications of the provider are pushed until the circuit half-opens
+            later = timezone.now() + timezone.timedelta(seconds=50)
+            self.assertGreater(notifications[2].datetime_scheduled, later)
+            self.assertGreater(Notification.objects.get(pk=pending.pk).datetime_scheduled, later)
+
+            # Single notifications are deferred too
+            notification = BreakerMessage.trigger(users[0])
+            notification.send()
+            self.assertEqual(notification.status, Notification.Status.CREATED)
+            self.assertGreater(notification.datetime_scheduled, later)
+
+    def test_send_many_opens_naive(self):
+
+        with self.settings(USE_TZ=False, TRANSMISSIONS_CIRCUIT_FAILURES=1):
+            users = [factories.User() for i in range(2)]
+            notifications = [BreakerMessage.trigger(user) for user in users]
+            pending = OtherBreakerMessage.trigger(users[0])
+
+            ProviderMessage.down = True
+            Notification.send_many(notifications)
+
+            # Pending notifications are rescheduled with naive datetimes
+            later = timezone.now() + timezone.timedelta(seconds=50)
+            self.assertGreater(Notification.objects.get(pk=pending.pk).datetime_scheduled, later)
+            self.assertEqual([Notification.objects.get(pk=notification.pk).attempts
+                              for notification in notifications], [1, 0])
+
+    def test_send_many_probe(self):
+
+        notifications = [BreakerMessage.trigger(factories.User()) for i in range(3)]
+
+        with self.settings(TRANSMISSIONS_CIRCUIT_FAILURES=1):
+            # Circuit half-open
+            CircuitBreaker.for_message(BreakerMessage).failure()
+            cache.delete('transmissions-circuit-{}-open'.format(CircuitBreaker.provider_of(BreakerMessage)))
+
+            with mock.patch('transmissions.models.Channel.send_many', wraps=lambda channels: [None] * len(channels)) \
+                    as mock_send_many:
+                Notification.send_many(notifications)
+
+            # Probe, then the rest once the circuit closed
+            self.assertEqual([len(call[0][0]) for call in mock_send_many.call_args_list], [1, 1, 1])
+            self.assertTrue(CircuitBreaker.for_message(BreakerMessage).allow())
+            self.assertEqual([Notification.objects.get(pk=notification.pk).status for notification in notifications],
+                             [Notification.Status.SUCCESSFULLY_SENT] * 3)
+
+    def test_cache_unavailable(self):
+
+        notifications = [BreakerMessage.trigger(factories.User()) for i in range(2)]
+
+        # Circuits are considered closed
+        with mock.patch.object(cache, 'get_many', side_effect=RuntimeError('Cache is down')), \
+                mock.patch.object(cache, 'incr', side_effect=RuntimeError('Cache is down')):
+            self.assertTrue(CircuitBreaker('unavailable').allow())
+            self.assertIsNone(CircuitBreaker('unavailable').failure())
+
+            Notification.send_many(notifications)
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_send_many_error_recorded(self):
+
+        notifications = [BreakerMessage.trigger(factories.User()) for i in range(2)]
+        Notification.objects.filter(pk__in=[notification.pk for notification in notifications])\
+            .update(status=Notification.Status.PROCESSING, claimed_by='worker')
+        notifications = [Notification.objects.get(pk=notification.pk) for notification in notifications]
+
+        # Error after the first slice was sent
+        with self.settings(TRANSMISSIONS_CIRCUIT_FAILURES=1), \
+                mock.patch('transmissions.models.Channel.send_many', side_effect=[[None], RuntimeError('Error')]):
+            with self.assertRaises(RuntimeError):
+                Notification.send_many(notifications)
+
+        # Outcome of the sent slice is recorded, the rest is released
+        notifications = [Notification.objects.get(pk=notification.pk) for notification in notifications]
+        self.assertEqual([notification.status for notification in notifications],
+                         [Notification.Status.SUCCESSFULLY_SENT, Notification.Status.CREATED])
+        self.assertEqual(notifications[1].claimed_by, '')
+
+    def test_send_failed_below_threshold(self):
+
+        notification = BreakerMessage.trigger(factories.User())
+        ProviderMessage.down = True
+        with self.settings(TRANSMISSIONS_MAX_ATTEMPTS=1):
+            notification.send()
+        self.assertEqual(notification.status, Notification.Status.FAILED)
+        self.assertEqual(len(mail.outbox), 0)
@@ -1,11 +1,14 @@
 import logging
+from smtplib import SMTPServerDisconnected
 
+import mock
 from django.test import TestCase
 from django.core import mail
 
 from transmissions import message
 from transmissions.models import Notification
 from transmissions.channels import Channel
+from transmissions.exceptions import ChannelSendException
 from transmissions.channels.email import DefaultEmailMessage
 from . import factories
 
@@ -15,9 +18,22 @@ TRIGGER_SIMPLE = 'simple-email'
 class SimpleMessage(DefaultEmailMessage):
     template_name = 'test'
 
+@message('failing-email', subject='Hello World!')
+class FailingMessage(DefaultEmailMessage):
+    template_name = 'test'
+
+    def send(self):
+        if self.to.username.endswith('fail'):
+            raise Exception('Invalid address')
+        super(FailingMessage, self).send()
+
 class EmailChannelTests(TestCase):
     def setUp(self):
         logging.disable(logging.WARNING)
+        Channel.teardown()
+
+    def tearDown(self):
+        Channel.teardown()
 
     def test_email_channel(self):
 
@@ -85,3 +101,84 @@ class EmailChannelTests(TestCase):
             self.assertEqual(mail.outbox[0].subject, 'Hello World!')
             self.assertEqual(mail.outbox[0].body, '')
             self.assertFalse(hasattr(mail.outbox[0], 'alternatives'))
+
+    def test_send_many(self):
+
+        users = [factories.User() for i in range(3)]
+        notifications = [SimpleMessage.trigger(user) for user in users]
+
+        with mock.patch('transmissions.channels.email.get_connection', wraps=mail.get_connection) as mock_connection, \
+                mock.patch('django.core.mail.get_connection') as mock_default_connection:
+            Notification.send_many(notifications)
+
+        # Emails were sent over a single connection
+        self.assertEqual(mock_connection.call_count, 1)
+        self.assertFalse(mock_default_connection.called)
+        self.assertEqual(len(mail.outbox), 3)
+
+        for notification in notifications:
+            notification = Notification.objects.get(pk=notification.id)
+            self.assertEqual(notification.status, Notification.Status.SUCCESSFULLY_SENT)
+            self.assertIsNotNone(notification.datetime_processed)
+
+    def test_send_many_failed(self):
+
+        users = [factories.User(), factories.User(username='fail'), factories.User()]
+        notifications = [FailingMessage.trigger(user) for user in users]
+
+        errors = Channel.send_many([Channel(notification) for notification in notifications])
+        self.assertIsNone(errors[0])
+        self.assertIsInstance(errors[1], ChannelSendException)
+        self.assertIsNone(errors[2])
+
+        # Status is recorded for each notification
+        with self.settings(TRANSMISSIONS_MAX_ATTEMPTS=1):
+            Notification.send_many(notifications)
+        self.assertEqual([Notification.objects.get(pk=notification.id).status for notification in notifications],
+                         [Notification.Status.SUCCESSFULLY_SENT, Notification.Status.FAILED,
+                          Notification.Status.SUCCESSFULLY_SENT])
+
+    def test_connection_reused(self):
+
+        users = [factories.User() for i in range(3)]
+        notifications = [SimpleMessage.trigger(user) for user in users]
+
+        with mock.patch('transmissions.channels.email.get_connection', wraps=mail.get_connection) as mock_connection:
+            for notification in notifications:
+                notification.send()
+            Notification.send_many([FailingMessage.trigger(user) for user in users])
+
+        # The connection opened by setup() is shared by all message classes
+        self.assertEqual(mock_connection.call_count, 1)
+        self.assertEqual(len(mail.outbox), 6)
+        self.assertIsNotNone(DefaultEmailMessage.connection)
+
+        connection = DefaultEmailMessage.connection
+        with mock.patch.object(connection, 'close') as mock_close:
+            Channel.teardown()
+        self.assertTrue(mock_close.called)
+        self.assertIsNone(DefaultEmailMessage.connection)
+
+    def test_setup_per_process(self):
+
+        notification = SimpleMessage.trigger(factories.User())
+        with mock.patch.object(DefaultEmailMessage, 'setup') as mock_setup:
+            Channel(notification)
+            Channel(notification)
+            self.assertEqual(mock_setup.call_count, 1)
+
+            # Forked worker process
+            with mock.patch('os.getpid', return_value=-1):
+                Channel(notification)
+            self.assertEqual(mock_setup.call_count, 2)
+
+    def test_reconnect(self):
+
+        notification = SimpleMessage.trigger(factories.User())
+        channel = Channel(notification)
+
+        connection = DefaultEmailMessage.connection
+        with mock.patch.object(connection, 'send_messages', side_effect=[SMTPServerDisconnected(), 1]), \
+                mock.patch.object(connection, 'open') as mock_open:
+            channel.message.send()
+        self.assertTrue(mock_open.called)
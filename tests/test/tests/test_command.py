@@ -5,6 +5,7 @@ import pytz
 from django.test import TestCase
 from django.utils import timezone
 from django.core.management import call_command
+from django.utils.six import StringIO
 
 import mock
 from transmissions import message
@@ -17,6 +18,29 @@ from . import factories
 class FailedAttemptMessage(DefaultEmailMessage):
     template_name = 'test'
 
+
+@message('command_test_other', behavior=None, subject='Hello World!')
+class OtherFailedAttemptMessage(DefaultEmailMessage):
+    template_name = 'test'
+
+
+class InlinePool(object):
+    """ Pool running tasks when they are submitted, as worker threads do not see the test transaction """
+
+    def __init__(self, workers):
+        self.workers = workers
+
+    def apply_async(self, func, args):
+        result = mock.Mock()
+        result.get.return_value = func(*args)
+        return result
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
 class CommandTests(TestCase):
 
     def setUp(self):
@@ -80,4 +104,76 @@ class CommandTests(TestCase):
         # Test
         call_command('retry_failed_notifications', days=8)
         notification = Notification.objects.get(pk=notification.id)
-        self.assertEqual(notification.status, Notification.Status.FAILED)
\ No newline at end of file
+        self.assertEqual(notification.status, Notification.Status.FAILED)
+
+    def failed(self, message_class, count):
+        notifications = [message_class.trigger(factories.User(), datetime_scheduled=None) for i in range(count)]
+        Notification.objects.filter(pk__in=[notification.pk for notification in notifications])\
+            .update(status=Notification.Status.FAILED, datetime_processed=timezone.now())
+        return notifications
+
+    def statuses(self, notifications):
+        return [Notification.objects.get(pk=notification.pk).status for notification in notifications]
+
+    def test_dry_run(self):
+
+        self.failed(FailedAttemptMessage, 3)
+        other = self.failed(OtherFailedAttemptMessage, 1)
+
+        out = StringIO()
+        call_command('retry_failed_notifications', dry_run=True, stdout=out)
+        self.assertIn('command_test: 3', out.getvalue())
+        self.assertIn('Dry run: 4 notifications would be retried', out.getvalue())
+        self.assertEqual(self.statuses(other), [Notification.Status.FAILED])
+
+        out = StringIO()
+        call_command('retry_failed_notifications', dry_run=True, triggers=['command_test'], limit=2, batch_size=1,
+                     stdout=out)
+        self.assertIn('Dry run: 2 notifications would be retried', out.getvalue())
+
+    def test_trigger_limit(self):
+
+        notifications = self.failed(FailedAttemptMessage, 3)
+        other = self.failed(OtherFailedAttemptMessage, 1)
+
+        out = StringIO()
+        call_command('retry_failed_notifications', triggers=['command_test'], limit=2, batch_size=1, stdout=out)
+        self.assertEqual(self.statuses(notifications), [Notification.Status.SUCCESSFULLY_SENT] * 2 +
+                         [Notification.Status.FAILED])
+        self.assertEqual(self.statuses(other), [Notification.Status.FAILED])
+        self.assertIn('Done: 2 notifications retried', out.getvalue())
+        self.assertIn('2 sent, 0 failed', out.getvalue())
+
+    def test_pool(self):
+
+        notifications = self.failed(FailedAttemptMessage, 5)
+
+        with mock.patch('transmissions.management.commands.retry_failed_notifications.ThreadPool', InlinePool):
+            call_command('retry_failed_notifications', workers=2, batch_size=2, stdout=StringIO())
+        self.assertEqual(self.statuses(notifications), [Notification.Status.SUCCESSFULLY_SENT] * 5)
+
+    def test_rate(self):
+
+        notifications = self.failed(FailedAttemptMessage, 2)
+
+        with mock.patch('transmissions.management.commands.retry_failed_notifications.time.sleep') as mock_sleep:
+            call_command('retry_failed_notifications', rate=1, batch_size=1, stdout=StringIO())
+        # The second notification waits for about a second
+        self.assertEqual(mock_sleep.call_count, 2)
+        self.assertTrue(0.5 < mock_sleep.call_args[0][0] <= 2)
+        self.assertEqual(self.statuses(notifications), [Notification.Status.SUCCESSFULLY_SENT] * 2)
+
+    def test_celery(self):
+
+        notifications = self.failed(FailedAttemptMessage, 3)
+
+        with mock.patch('transmissions.management.commands.retry_failed_notifications.dispatch_rows') \
+                as mock_dispatch_rows:
+            call_command('retry_failed_notifications', mode='celery', batch_size=2, stdout=StringIO())
+
+        # Requeued, and enqueued by batch
+        self.assertEqual([[row[1] for row in call[0][0]] for call in mock_dispatch_rows.call_args_list],
+                         [[notifications[0].pk, notifications[1].pk], [notifications[2].pk]])
+        self.assertEqual(self.statuses(notifications), [Notification.Status.CREATED] * 3)
+        self.assertFalse(Notification.objects.filter(pk=notifications[0].pk, datetime_processed__isnull=False)
+                         .exists())
@@ -4,6 +4,8 @@ from django.test import TestCase
 
 from transmissions import message
 from transmissions.channels import Channel
+from transmissions.exceptions import DuplicateTriggerException
+from transmissions.trigger import register
 from transmissions.channels.email import DefaultEmailMessage
 from . import factories
 
@@ -36,4 +38,18 @@ class DecoratorTests(TestCase):
 
             # Check channel and template are correct
             channel = Channel(notification)
-            self.assertIsInstance(channel.message, HelloWorld)
\ No newline at end of file
+            self.assertIsInstance(channel.message, HelloWorld)
+
+    def test_autodiscover(self):
+
+        # Registered at startup from the notifications module of the test app
+        self.assertEqual(register['autodiscovered'].__module__, 'test.notifications')
+
+    def test_duplicate(self):
+
+        with self.assertRaises(DuplicateTriggerException):
+            @message('welcome', behavior=None)
+            class OtherHelloWorld(DefaultEmailMessage):
+                pass
+
+        self.assertIs(register['welcome'], HelloWorld)
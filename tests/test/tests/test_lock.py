@@ -1,13 +1,17 @@
+import itertools
 import logging
 
+import mock
 from django.core.cache import cache
 from django.test import TestCase
-from transmissions.lock import lock
+from transmissions.exceptions import LockTimeout
+from transmissions.lock import lock, acquire_lock, release_lock, stats, DatabaseLockBackend
 
 class LockTests(TestCase):
 
     def setUp(self):
         logging.disable(logging.WARNING)
+        stats.reset()
 
     def test_simple(self):
 
@@ -16,6 +20,8 @@ class LockTests(TestCase):
             v = 2
 
         self.assertEqual(v, 2)
+        self.assertEqual(stats.acquisitions, 1)
+        self.assertEqual(stats.timeouts, 0)
 
     def test_fail(self):
 
@@ -23,10 +29,72 @@ class LockTests(TestCase):
         key = 'fail'
         lock_id = 'lock-transmission-{0}'.format(key)
         cache.add(lock_id, 1, 200)
-        with self.assertRaisesMessage(RuntimeError, 'Lock could not be acquired after 110ms'):
+        with self.assertRaisesMessage(RuntimeError, 'Lock could not be acquired after'):
             with lock(key, 100):
                 v = 2
         cache.delete(lock_id)
 
         self.assertEqual(v, 1)
+        self.assertEqual(stats.timeouts, 1)
+        self.assertGreaterEqual(stats.wait_ms, 100)
 
+    def test_try_lock(self):
+
+        with lock('try'):
+            with mock.patch('time.sleep') as mock_sleep:
+                with self.assertRaises(LockTimeout):
+                    acquire_lock('try', timeout=0)
+            self.assertFalse(mock_sleep.called)
+
+    def test_backoff(self):
+
+        with lock('backoff'):
+            with mock.patch('time.sleep') as mock_sleep:
+                with mock.patch('time.time', side_effect=itertools.count(0, 0.001)):
+                    with self.assertRaises(LockTimeout):
+                        acquire_lock('backoff', timeout=10000)
+
+        delays = [call[0][0] for call in mock_sleep.call_args_list]
+        self.assertTrue(0.005 <= delays[0] <= 0.01)
+        self.assertTrue(0.01 <= delays[1] <= 0.02)
+        # Delay is capped
+        self.assertTrue(0.25 <= delays[10] <= 0.5)
+        self.assertLessEqual(max(delays), 0.5)
+
+    def test_release_expired(self):
+
+        handle = acquire_lock('expired', ttl=60)
+
+        # Lock expired and was acquired by another worker
+        cache.delete(handle[0])
+        other_handle = acquire_lock('expired')
+
+        release_lock(handle)
+        with self.assertRaises(LockTimeout):
+            acquire_lock('expired', timeout=0)
+
+        release_lock(other_handle)
+        release_lock(acquire_lock('expired', timeout=0))
+
+    def test_local_backend(self):
+
+        with self.settings(TRANSMISSIONS_LOCK_BACKEND='transmissions.lock.LocalLockBackend'):
+            with lock('local'):
+                self.assertIsNone(cache.get('lock-transmission-local'))
+                with self.assertRaises(LockTimeout):
+                    acquire_lock('local', timeout=0)
+
+            handle = acquire_lock('local', timeout=0, ttl=0)
+            # Lock expired
+            other_handle = acquire_lock('local', timeout=0)
+            release_lock(handle)
+            with self.assertRaises(LockTimeout):
+                acquire_lock('local', timeout=0)
+            release_lock(other_handle)
+
+    def test_database_advisory_key(self):
+
+        key = DatabaseLockBackend.advisory_key('lock-transmission-key')
+        self.assertEqual(key, DatabaseLockBackend.advisory_key('lock-transmission-key'))
+        self.assertNotEqual(key, DatabaseLockBackend.advisory_key('lock-transmission-other'))
+        self.assertTrue(0 <= key < 2 ** 63)
@@ -1,9 +1,14 @@
 import logging
 
+import mock
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils.six import StringIO
 from django.utils import timezone
 
-from transmissions.models import Notification, TriggerBehavior
+from transmissions.models import Notification, NotificationLedger, NotificationQuerySet, TriggerBehavior
 from transmissions.channels.email import DefaultEmailMessage
 from transmissions import exceptions, message
 from . import factories
@@ -39,6 +44,38 @@ TRIGGER_DELETE_AFTER_PROCESSING = 'trigger_delete_after'
 class TriggerDeleteAfterMessage(DefaultEmailMessage):
     template_name = 'test'
 
+TRIGGER_LAST_ONLY = 'last_only'
+@message(TRIGGER_LAST_ONLY, behavior=TriggerBehavior.LAST_ONLY)
+class LastOnlyMessage(DefaultEmailMessage):
+    template_name = 'test'
+
+TRIGGER_VALIDITY_MANY = 'validity_many'
+@message(TRIGGER_VALIDITY_MANY)
+class ValidityManyMessage(DefaultEmailMessage):
+    template_name = 'test'
+
+    @classmethod
+    def check_validity_many(cls, notifications):
+        return [notification for notification in notifications if notification.data.get('valid')]
+
+TRIGGER_PREFETCH = 'prefetch'
+@message(TRIGGER_PREFETCH, prefetch_related=('content', 'target_user__groups'))
+class PrefetchMessage(DefaultEmailMessage):
+    template_name = 'test'
+
+TRIGGER_MUTATE_DATA = 'mutate_data'
+@message(TRIGGER_MUTATE_DATA)
+class MutateDataMessage(DefaultEmailMessage):
+    template_name = 'test'
+
+    def __init__(self, notification):
+        super(MutateDataMessage, self).__init__(notification)
+        self.notification = notification
+
+    def send(self):
+        super(MutateDataMessage, self).send()
+        self.notification.data['provider_id'] = self.notification.pk
+
 class ModelTests(TestCase):
 
     def setUp(self):
@@ -236,3 +273,327 @@ class ModelTests(TestCase):
             self.assertEqual(notification.status, Notification.Status.BROKEN)
             self.assertEqual(notification.data, '{}')
 
+
+    def test_data_not_serialized(self):
+
+        notification = SimpleMessage.trigger(factories.User(), data={'key': 'value'})
+        data_pickled = notification.data_pickled
+
+        notification = Notification.objects.get(pk=notification.pk)
+        with mock.patch('transmissions.models.serializer.dumps') as mock_dumps:
+            notification.send()
+            Notification.objects.get(pk=notification.pk).save()
+        self.assertFalse(mock_dumps.called)
+
+        notification = Notification.objects.get(pk=notification.pk)
+        self.assertEqual(notification.status, Notification.Status.SUCCESSFULLY_SENT)
+        self.assertEqual(notification.data_pickled, data_pickled)
+
+    def test_data_assigned(self):
+
+        notification = SimpleMessage.trigger(factories.User(), data={'key': 'value'})
+
+        notification = Notification.objects.get(pk=notification.pk)
+        notification.data = {'key': 'other'}
+        notification.cancel()
+        self.assertEqual(Notification.objects.get(pk=notification.pk).data, {'key': 'other'})
+
+        # Data mutated in place
+        notification = Notification.objects.get(pk=notification.pk)
+        notification.data['key'] = 'mutated'
+        notification.save()
+        self.assertEqual(Notification.objects.get(pk=notification.pk).data, {'key': 'mutated'})
+
+    def test_data_mutated(self):
+
+        notifications = [MutateDataMessage.trigger(factories.User(), data={'key': 'value'}) for i in range(3)]
+
+        # Data changed in place while sending is saved
+        notification = Notification.objects.get(pk=notifications[0].pk)
+        notification.send()
+        self.assertEqual(Notification.objects.get(pk=notification.pk).data,
+                         {'key': 'value', 'provider_id': notification.pk})
+
+        Notification.send_many([Notification.objects.get(pk=notification.pk) for notification in notifications[1:]])
+        for notification in notifications[1:]:
+            notification = Notification.objects.get(pk=notification.pk)
+            self.assertEqual(notification.status, Notification.Status.SUCCESSFULLY_SENT)
+            self.assertEqual(notification.data, {'key': 'value', 'provider_id': notification.pk})
+
+        # Data accessed but not changed is not saved again
+        notification = Notification.objects.get(pk=notifications[0].pk)
+        notification.data
+        self.assertNotIn('data_pickled', notification.status_fields())
+
+    def test_send_many_grouped_writes(self):
+
+        users = [factories.User() for i in range(3)]
+        sent = [SimpleMessage.trigger(user) for user in users]
+        deleted = [TriggerDeleteAfterMessage.trigger(user) for user in users]
+        assigned = SimpleMessage.trigger(users[0])
+        assigned.data = {'key': 'value'}
+
+        with mock.patch.object(SimpleMessage, 'check_validity', side_effect=[True, False, True, True]), \
+                CaptureQueriesContext(connection) as queries:
+            Notification.send_many(sent + deleted + [assigned])
+
+        # One UPDATE per status, one for the assigned data and a single DELETE
+        statements = [query['sql'] for query in queries.captured_queries]
+        self.assertEqual(len([sql for sql in statements if sql.startswith('UPDATE "transmissions_notification" ')]), 3)
+        self.assertEqual(len([sql for sql in statements if sql.startswith('DELETE FROM "transmissions_notification" ')]), 1)
+
+        self.assertEqual([Notification.objects.get(pk=notification.pk).status for notification in sent],
+                         [Notification.Status.SUCCESSFULLY_SENT, Notification.Status.CANCELLED,
+                          Notification.Status.SUCCESSFULLY_SENT])
+        self.assertFalse(Notification.objects.filter(trigger_name=TRIGGER_DELETE_AFTER_PROCESSING).exists())
+        self.assertTrue(all(notification.pk is None for notification in deleted))
+        self.assertEqual(Notification.objects.get(pk=assigned.pk).data, {'key': 'value'})
+        self.assertIsNotNone(Notification.objects.get(pk=assigned.pk).datetime_processed)
+
+    def test_check_validity_many(self):
+
+        user = factories.User()
+        notifications = [ValidityManyMessage.trigger(user, data={'valid': valid}) for valid in (True, False, True)]
+
+        with mock.patch.object(ValidityManyMessage, 'check_validity_many',
+                               wraps=ValidityManyMessage.check_validity_many) as mock_check_validity_many:
+            Notification.send_many(notifications)
+        self.assertEqual(mock_check_validity_many.call_count, 1)
+        self.assertEqual([Notification.objects.get(pk=notification.pk).status for notification in notifications],
+                         [Notification.Status.SUCCESSFULLY_SENT, Notification.Status.CANCELLED,
+                          Notification.Status.SUCCESSFULLY_SENT])
+
+        # Single notifications are checked the same way
+        notification = ValidityManyMessage.trigger(user, data={'valid': False})
+        notification.send()
+        self.assertEqual(notification.status, Notification.Status.CANCELLED)
+
+    def test_check_validity_many_broken(self):
+
+        notifications = [ValidityManyMessage.trigger(factories.User()) for i in range(2)]
+        with mock.patch.object(ValidityManyMessage, 'check_validity_many', side_effect=Exception('Broken')):
+            Notification.send_many(notifications)
+        self.assertEqual([Notification.objects.get(pk=notification.pk).status for notification in notifications],
+                         [Notification.Status.BROKEN, Notification.Status.BROKEN])
+
+    @mock.patch.object(NotificationQuerySet, 'select_for_update', lambda self, **kwargs: self)
+    def test_prefetch_many(self):
+
+        users = [factories.User() for i in range(3)]
+        for user in users:
+            SimpleMessage.trigger(user, content=users[0])
+            PrefetchMessage.trigger(user, content=user)
+
+        notifications = Notification.objects.filter(target_user__in=users).claim()
+        with self.assertNumQueries(3):
+            # Contents of each trigger, groups of target users
+            Notification.prefetch_many(notifications)
+
+        with self.assertNumQueries(0):
+            for notification in notifications:
+                self.assertEqual(notification.target_user.pk, notification.target_user_id)
+                self.assertIsNone(notification.trigger_user)
+                self.assertIsNotNone(notification.content)
+            prefetched = [notification for notification in notifications if notification.trigger_name == TRIGGER_PREFETCH]
+            self.assertEqual(list(prefetched[0].target_user.groups.all()), [])
+
+    @mock.patch.object(NotificationQuerySet, 'select_for_update', lambda self, **kwargs: self)
+    def test_claim(self):
+
+        user = factories.User()
+        notifications = [SimpleMessage.trigger(user) for i in range(3)]
+        processed = SimpleMessage.trigger(user)
+        processed.cancel()
+
+        claimed = Notification.objects.filter(target_user=user).order_by('id').claim(limit=2)
+        self.assertEqual([notification.id for notification in claimed],
+                         [notification.id for notification in notifications[:2]])
+        for notification in claimed:
+            self.assertEqual(notification.status, Notification.Status.PROCESSING)
+
+        # Claimed and processed notifications are not claimed again
+        claimed = Notification.objects.filter(target_user=user).claim()
+        self.assertEqual([notification.id for notification in claimed], [notifications[2].id])
+        self.assertEqual(Notification.objects.filter(target_user=user).claim(), [])
+
+    def test_trigger_many(self):
+
+        users = [factories.User() for i in range(3)]
+        data = {'hello': 'World'}
+
+        notifications = SimpleMessage.trigger_many(users + users[:1], content=users[0], data=data)
+        self.assertEqual(len(notifications), 4)
+
+        notifications = Notification.objects.filter(trigger_name=TRIGGER_SIMPLE).order_by('id')
+        self.assertEqual([notification.target_user for notification in notifications], users + users[:1])
+        for notification in notifications:
+            self.assertEqual(notification.status, Notification.Status.CREATED)
+            self.assertEqual(notification.content, users[0])
+            self.assertEqual(notification.data, data)
+            self.assertTrue(notification.uuid)
+
+    def test_trigger_many_send_once(self):
+
+        users = [factories.User() for i in range(3)]
+        SendOnceMessage.trigger(users[0])
+
+        # Ledger lookup, notifications insert and ids, ledger insert, and savepoints
+        with self.assertNumQueries(8):
+            notifications = SendOnceMessage.trigger_many(users + users[1:2])
+        self.assertEqual([notification.target_user for notification in notifications], users[1:])
+
+        self.assertEqual(SendOnceMessage.trigger_many(users), [])
+        self.assertEqual(Notification.objects.filter(trigger_name=TRIGGER_SEND_ONCE).count(), 3)
+
+    def test_trigger_many_trigger_once_per_content(self):
+
+        users = [factories.User() for i in range(2)]
+        notification = TriggerOncePerContentMessage.trigger(users[0], content=users[0])
+        TriggerOncePerContentMessage.trigger(users[1], content=users[1])
+
+        notifications = TriggerOncePerContentMessage.trigger_many(users, content=users[0])
+        self.assertEqual([notification.target_user for notification in notifications], users[1:])
+
+        # Once processed, notification can be triggered again
+        notification.cancel()
+        notifications = TriggerOncePerContentMessage.trigger_many(users, content=users[0])
+        self.assertEqual([notification.target_user for notification in notifications], users[:1])
+
+    def test_trigger_many_last_only(self):
+
+        users = [factories.User() for i in range(2)]
+        pending = LastOnlyMessage.trigger(users[0])
+
+        # Cancellation, notifications insert and ids, and savepoint
+        with self.assertNumQueries(5):
+            notifications = LastOnlyMessage.trigger_many(users)
+        self.assertEqual(len(notifications), 2)
+
+        pending = Notification.objects.get(pk=pending.id)
+        self.assertEqual(pending.status, Notification.Status.CANCELLED)
+        self.assertIsNotNone(pending.datetime_processed)
+        self.assertEqual(Notification.objects.filter(trigger_name=TRIGGER_LAST_ONLY,
+                                                     status=Notification.Status.CREATED).count(), 2)
+
+    def test_trigger_notification_last_only(self):
+
+        user = factories.User()
+        other_user = factories.User()
+        notifications = [LastOnlyMessage.trigger(user) for i in range(3)]
+        other_notification = LastOnlyMessage.trigger(other_user)
+
+        for notification in notifications[:-1]:
+            notification = Notification.objects.get(pk=notification.id)
+            self.assertEqual(notification.status, Notification.Status.CANCELLED)
+            self.assertIsNotNone(notification.datetime_processed)
+
+        self.assertEqual(Notification.objects.get(pk=notifications[-1].id).status, Notification.Status.CREATED)
+        self.assertEqual(Notification.objects.get(pk=other_notification.id).status, Notification.Status.CREATED)
+
+    def test_cancel_pending(self):
+
+        user = factories.User()
+        other_user = factories.User()
+        notification = SimpleMessage.trigger(user, content=user)
+        other_content_notification = SimpleMessage.trigger(user, content=other_user)
+        other_user_notification = SimpleMessage.trigger(other_user, content=user)
+        other_trigger_notification = SendOnceMessage.trigger(user)
+        sent_notification = SimpleMessage.trigger(user, content=user)
+        sent_notification.send()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(SimpleMessage.cancel_pending(target_user=user, content=user), 1)
+
+        notification = Notification.objects.get(pk=notification.id)
+        self.assertEqual(notification.status, Notification.Status.CANCELLED)
+        self.assertIsNotNone(notification.datetime_processed)
+        for other in (other_content_notification, other_user_notification, other_trigger_notification):
+            self.assertEqual(Notification.objects.get(pk=other.id).status, Notification.Status.CREATED)
+        self.assertEqual(Notification.objects.get(pk=sent_notification.id).status,
+                         Notification.Status.SUCCESSFULLY_SENT)
+
+        # Cancel by arbitrary filter
+        self.assertEqual(Notification.objects.filter(target_user=user).cancel(), 2)
+        self.assertEqual(Notification.objects.get(pk=other_user_notification.id).status,
+                         Notification.Status.CREATED)
+
+    def test_trigger_notification_send_once_purged(self):
+
+        user = factories.User()
+        notification = SendOnceMessage.trigger(user)
+
+        # Ledger still knows about purged notifications
+        Notification.objects.filter(pk=notification.id).delete()
+        self.assertIsNone(SendOnceMessage.trigger(user))
+        self.assertFalse(Notification.objects.filter(trigger_name=TRIGGER_SEND_ONCE).exists())
+
+    def test_trigger_notification_once_without_lock(self):
+
+        user = factories.User()
+        with mock.patch('transmissions.trigger.lock') as mock_lock:
+            self.assertIsNotNone(SendOnceMessage.trigger(user))
+            self.assertIsNone(SendOnceMessage.trigger(user))
+            self.assertIsNotNone(TriggerOncePerContentMessage.trigger(user, content=user))
+            self.assertIsNone(TriggerOncePerContentMessage.trigger(user, content=user))
+        self.assertFalse(mock_lock.called)
+
+    def test_trigger_notification_trigger_once_deleted(self):
+
+        user = factories.User()
+        notification = TriggerOnceMessage.trigger(user)
+
+        # Deleted notification is not pending anymore
+        Notification.objects.filter(pk=notification.id).delete()
+        new_notification = TriggerOnceMessage.trigger(user)
+        self.assertIsNotNone(new_notification)
+        self.assertEqual(NotificationLedger.objects.get(trigger_name=TRIGGER_ONCE).notification, new_notification)
+
+    def test_trigger_notification_trigger_once_takeover_race(self):
+
+        user = factories.User()
+        processed = TriggerOnceMessage.trigger(user)
+        processed.cancel()
+        entry = NotificationLedger.objects.get(trigger_name=TRIGGER_ONCE)
+        taken_over = TriggerOnceMessage.trigger(user)
+
+        # Another trigger read the entry as stale before it was taken over
+        with mock.patch('django.db.models.query.QuerySet.first', return_value=(entry.pk, processed.pk)):
+            self.assertIsNone(TriggerOnceMessage.trigger(user))
+        self.assertEqual(NotificationLedger.objects.get(pk=entry.pk).notification, taken_over)
+        self.assertEqual(Notification.objects.filter(trigger_name=TRIGGER_ONCE).count(), 2)
+
+    def test_trigger_many_trigger_once_ledger(self):
+
+        users = [factories.User() for i in range(3)]
+        processed = TriggerOnceMessage.trigger(users[0])
+        processed.cancel()
+        TriggerOnceMessage.trigger(users[1])
+
+        notifications = TriggerOnceMessage.trigger_many(users)
+        self.assertEqual([notification.target_user for notification in notifications], [users[0], users[2]])
+        self.assertEqual(dict(NotificationLedger.objects.filter(trigger_name=TRIGGER_ONCE)
+                              .values_list('target_user_id', 'notification_id')),
+                         {users[0].id: notifications[0].id, users[2].id: notifications[1].id,
+                          users[1].id: Notification.objects.get(target_user=users[1]).id})
+
+    def test_populate_notification_ledger(self):
+
+        user = factories.User()
+        other_user = factories.User()
+        notification = SendOnceMessage.trigger(user)
+        pending = TriggerOnceMessage.trigger(user)
+        processed = TriggerOnceMessage.trigger(other_user)
+        processed.cancel()
+
+        # Notifications triggered before the ledger existed
+        NotificationLedger.objects.all().delete()
+        call_command('populate_notification_ledger', stdout=StringIO())
+
+        self.assertEqual(NotificationLedger.objects.get(trigger_name=TRIGGER_SEND_ONCE).notification, notification)
+        self.assertEqual(NotificationLedger.objects.get(trigger_name=TRIGGER_ONCE).notification, pending)
+        self.assertIsNone(SendOnceMessage.trigger(user))
+
+        # Running again does not record twice
+        call_command('populate_notification_ledger', stdout=StringIO())
+        self.assertEqual(NotificationLedger.objects.filter(trigger_name__in=(TRIGGER_SEND_ONCE, TRIGGER_ONCE))
+                         .count(), 2)
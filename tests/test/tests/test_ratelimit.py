@@ -0,0 +1,113 @@
+import logging
+
+import mock
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core import mail
+from django.test import TestCase
+from django.utils import timezone
+
+from transmissions import message
+from transmissions.channels.email import DefaultEmailMessage
+from transmissions.models import Notification
+from transmissions.ratelimit import (CacheRateLimitBackend, LocalRateLimitBackend, get_limits, parse_rate,
+                                     throttle)
+from . import factories
+
+
+@message('ratelimit_test', behavior=None, subject='Hello World!', rate_limit='2/m')
+class RateLimitedMessage(DefaultEmailMessage):
+    template_name = 'test'
+
+
+class RateLimitTests(TestCase):
+
+    def setUp(self):
+        logging.disable(logging.WARNING)
+        cache.clear()
+
+    def test_parse_rate(self):
+
+        self.assertEqual(parse_rate('10/s'), (10, 1))
+        self.assertEqual(parse_rate('600/m'), (600, 60))
+        with self.assertRaises(ImproperlyConfigured):
+            parse_rate('10 per second')
+
+    def test_backends(self):
+
+        for backend in (LocalRateLimitBackend(), CacheRateLimitBackend()):
+            self.assertEqual(backend.acquire('backend', 2, 60), 0)
+            self.assertEqual(backend.acquire('backend', 2, 60), 0)
+
+            # Bucket is empty, next token in about 30 seconds
+            wait = backend.acquire('backend', 2, 60)
+            self.assertTrue(29 < wait <= 30)
+
+            backend.refund('backend', 2, 60)
+            self.assertEqual(backend.acquire('backend', 2, 60), 0)
+
+    def test_saturated(self):
+
+        # Saturated for several periods, the bucket never comes back full
+        for backend in (LocalRateLimitBackend(), CacheRateLimitBackend()):
+            clock = [1000.0]
+            allowed = 0
+            with mock.patch('time.time', lambda: clock[0]):
+                for i in range(1000):
+                    if backend.acquire('saturated', 10, 1) == 0:
+                        allowed += 1
+                    clock[0] += 0.01
+            # 10 tokens at first, then 10 per second for 10 seconds
+            self.assertTrue(105 <= allowed <= 111, allowed)
+
+    def test_cache_fallback(self):
+
+        backend = CacheRateLimitBackend()
+        with mock.patch.object(cache, 'incr', side_effect=RuntimeError('Cache is down')):
+            self.assertEqual(backend.acquire('fallback', 1, 60), 0)
+            self.assertGreater(backend.acquire('fallback', 1, 60), 0)
+
+    def test_limits(self):
+
+        self.assertEqual(get_limits(RateLimitedMessage), [('trigger-ratelimit_test', 2, 60)])
+        with self.settings(TRANSMISSIONS_RATE_LIMITS={'EMAIL': '10/s'}):
+            self.assertEqual(get_limits(RateLimitedMessage), [('channel-1', 10, 1), ('trigger-ratelimit_test', 2, 60)])
+
+        # A token is taken from every bucket, or none
+        with self.settings(TRANSMISSIONS_RATE_LIMITS={'EMAIL': '3/m'}):
+            self.assertEqual(throttle(RateLimitedMessage), 0)
+            self.assertEqual(throttle(RateLimitedMessage), 0)
+            self.assertGreater(throttle(RateLimitedMessage), 0)
+
+            with mock.patch.dict(RateLimitedMessage.kwargs, {'rate_limit': None}):
+                self.assertEqual(throttle(RateLimitedMessage), 0)
+                self.assertGreater(throttle(RateLimitedMessage), 0)
+
+    def test_send_deferred(self):
+
+        notifications = [RateLimitedMessage.trigger(factories.User()) for i in range(3)]
+        for notification in notifications:
+            notification.send()
+
+        self.assertEqual(len(mail.outbox), 2)
+        notification = Notification.objects.get(pk=notifications[2].pk)
+        self.assertEqual(notification.status, Notification.Status.CREATED)
+        self.assertIsNone(notification.datetime_processed)
+        self.assertGreater(notification.datetime_scheduled, timezone.now() + timezone.timedelta(seconds=25))
+
+    def test_send_many_deferred(self):
+
+        notifications = [RateLimitedMessage.trigger(factories.User()) for i in range(4)]
+        Notification.objects.filter(pk__in=[notification.pk for notification in notifications])\
+            .update(status=Notification.Status.PROCESSING, claimed_by='worker')
+        Notification.send_many(notifications)
+
+        self.assertEqual(len(mail.outbox), 2)
+        notifications = [Notification.objects.get(pk=notification.pk) for notification in notifications]
+        self.assertEqual([notification.status for notification in notifications],
+                         [Notification.Status.SUCCESSFULLY_SENT, Notification.Status.SUCCESSFULLY_SENT,
+                          Notification.Status.CREATED, Notification.Status.CREATED])
+        self.assertEqual(notifications[2].claimed_by, '')
+
+        # Deferred notifications are spread at the rate of the limit
+        self.assertEqual((notifications[3].datetime_scheduled - notifications[2].datetime_scheduled).seconds, 30)
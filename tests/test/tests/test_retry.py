@@ -0,0 +1,142 @@
+import logging
+
+import mock
+from django.core import mail
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from transmissions import message
+from transmissions.channels.email import DefaultEmailMessage
+from transmissions.exceptions import ChannelSendException
+from transmissions.models import Notification, get_max_attempts, get_retry_delay
+from transmissions.tasks import process_notification
+from . import factories
+
+
+class FlakyMessage(DefaultEmailMessage):
+    down = False
+
+    def send(self):
+        if FlakyMessage.down:
+            raise ChannelSendException('Provider is down')
+        super(FlakyMessage, self).send()
+
+
+@message('retry_test', behavior=None, subject='Hello World!')
+class RetryMessage(FlakyMessage):
+    template_name = 'test'
+
+
+@message('retry_test_twice', behavior=None, subject='Hello World!', max_attempts=2)
+class RetryTwiceMessage(FlakyMessage):
+    template_name = 'test'
+
+
+class RetryTests(TestCase):
+
+    def setUp(self):
+        logging.disable(logging.WARNING)
+        cache.clear()
+        FlakyMessage.down = False
+        self.addCleanup(setattr, FlakyMessage, 'down', False)
+
+    def test_max_attempts(self):
+
+        self.assertEqual(get_max_attempts('retry_test'), 3)
+        self.assertEqual(get_max_attempts('retry_test_twice'), 2)
+        with self.settings(TRANSMISSIONS_MAX_ATTEMPTS=5):
+            self.assertEqual(get_max_attempts('retry_test'), 5)
+            self.assertEqual(get_max_attempts('retry_test_twice'), 2)
+
+    def test_retry_delay(self):
+
+        with self.settings(TRANSMISSIONS_RETRY_BACKOFF=10, TRANSMISSIONS_RETRY_BACKOFF_MAX=60):
+            for attempts, delay in ((1, 10), (2, 20), (3, 40), (4, 60), (10, 60)):
+                seconds = get_retry_delay(attempts).total_seconds()
+                self.assertTrue(delay / 2.0 <= seconds <= delay)
+                self.assertEqual(seconds, int(seconds))
+
+    def test_send_retried(self):
+
+        notification = RetryTwiceMessage.trigger(factories.User())
+        FlakyMessage.down = True
+        notification.send()
+
+        notification = Notification.objects.get(pk=notification.pk)
+        self.assertEqual(notification.status, Notification.Status.CREATED)
+        self.assertEqual(notification.attempts, 1)
+        self.assertIsNone(notification.datetime_processed)
+        self.assertGreater(notification.datetime_next_attempt, timezone.now() + timezone.timedelta(seconds=25))
+
+        # Not dispatched before its next attempt
+        self.assertFalse(Notification.objects.due().filter(pk=notification.pk).exists())
+        self.assertTrue(Notification.objects.due(now=notification.datetime_next_attempt)
+                        .filter(pk=notification.pk).exists())
+
+        # Terminally failed after the last attempt
+        notification.send()
+        notification = Notification.objects.get(pk=notification.pk)
+        self.assertEqual(notification.status, Notification.Status.FAILED)
+        self.assertEqual(notification.attempts, 2)
+        self.assertIsNone(notification.datetime_next_attempt)
+        self.assertIsNotNone(notification.datetime_processed)
+
+    def test_stale_task(self):
+
+        notification = RetryMessage.trigger(factories.User())
+        FlakyMessage.down = True
+        process_notification(notification.pk)
+        FlakyMessage.down = False
+
+        # A task enqueued again for the notification does not send it before its next attempt
+        process_notification(notification.pk)
+        notification = Notification.objects.get(pk=notification.pk)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(notification.status, Notification.Status.CREATED)
+        self.assertEqual(notification.attempts, 1)
+        self.assertEqual(Notification.objects.filter(pk=notification.pk).claim(), [])
+
+        Notification.objects.filter(pk=notification.pk).update(datetime_next_attempt=timezone.now())
+        process_notification(notification.pk)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(Notification.objects.get(pk=notification.pk).attempts, 2)
+
+    def test_send_many_retried(self):
+
+        notifications = [RetryMessage.trigger(factories.User()) for i in range(2)]
+        FlakyMessage.down = True
+        Notification.send_many(notifications)
+
+        notifications = [Notification.objects.get(pk=notification.pk) for notification in notifications]
+        self.assertEqual([notification.status for notification in notifications], [Notification.Status.CREATED] * 2)
+        self.assertEqual([notification.attempts for notification in notifications], [1, 1])
+        self.assertTrue(all(notification.datetime_next_attempt for notification in notifications))
+
+        # Sent on the next attempt
+        FlakyMessage.down = False
+        Notification.send_many(notifications)
+        self.assertEqual(len(mail.outbox), 2)
+        notifications = [Notification.objects.get(pk=notification.pk) for notification in notifications]
+        self.assertEqual([notification.status for notification in notifications],
+                         [Notification.Status.SUCCESSFULLY_SENT] * 2)
+        self.assertEqual([notification.attempts for notification in notifications], [2, 2])
+        self.assertEqual([notification.datetime_next_attempt for notification in notifications], [None, None])
+
+    def test_send_many_retries_grouped(self):
+
+        notifications = [RetryMessage.trigger(factories.User()) for i in range(5)]
+        FlakyMessage.down = True
+        with self.settings(TRANSMISSIONS_CIRCUIT_FAILURES=None), \
+                mock.patch('transmissions.models.random.randint', return_value=5), \
+                CaptureQueriesContext(connection) as queries:
+            Notification.send_many(notifications)
+
+        # Retries with the same delay are released with a single UPDATE
+        updates = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        notifications = [Notification.objects.get(pk=notification.pk) for notification in notifications]
+        self.assertEqual(len(set(notification.datetime_next_attempt for notification in notifications)), 1)
+        self.assertEqual(notifications[0].datetime_next_attempt.microsecond, 0)
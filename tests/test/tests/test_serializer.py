@@ -0,0 +1,131 @@
+import json
+import logging
+import time
+import unittest
+
+import mock
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils.six import StringIO
+
+from transmissions import message
+from transmissions.management.commands import benchmark_serializers
+from transmissions.models import Notification
+from transmissions.channels.email import DefaultEmailMessage
+from transmissions.serializer import JSONSerializer, MsgpackSerializer, pack, unpack
+from . import factories
+
+
+@message('serializer_test', behavior=None)
+class SerializerTestMessage(DefaultEmailMessage):
+    template_name = 'test'
+
+
+class SerializerTests(TestCase):
+
+    def setUp(self):
+        logging.disable(logging.WARNING)
+
+    def test_json(self):
+
+        data = {'key': ['value', 1, 2.5, True, None]}
+        self.assertEqual(JSONSerializer().loads(JSONSerializer().dumps(data)), data)
+
+    def test_msgpack(self):
+
+        try:
+            serializer = MsgpackSerializer()
+        except ImproperlyConfigured:
+            self.skipTest('msgpack is not installed')
+
+        data = {'key': ['value', 1, 2.5, True, None]}
+        self.assertEqual(serializer.loads(serializer.dumps(data)), data)
+
+    def test_pack(self):
+
+        data = {'key': 'value'}
+        for format in ('serializer', 'json'):
+            payload = pack(data, format=format)
+            self.assertIsInstance(payload, bytes)
+            self.assertEqual(unpack(payload), data)
+
+        with self.assertRaises(ImproperlyConfigured):
+            pack(data, format='yaml')
+
+    def test_pack_compressed(self):
+
+        data = {'key': 'value' * 1000}
+        payload = pack(data, format='json', compress_threshold=100)
+        self.assertLess(len(payload), 100)
+        self.assertEqual(unpack(payload), data)
+
+        # Under the threshold
+        self.assertEqual(pack(data, format='json', compress_threshold=10 ** 6)[1:], JSONSerializer().dumps(data))
+
+    def test_binary_storage(self):
+
+        with self.settings(TRANSMISSIONS_DATA_STORAGE='binary', TRANSMISSIONS_DATA_FORMAT='json'):
+            notification = SerializerTestMessage.trigger(factories.User(), data={'key': 'value'})
+            notification = Notification.objects.get(pk=notification.pk)
+            self.assertEqual(notification.data_pickled, '')
+            self.assertIsNotNone(notification.data_binary)
+            self.assertEqual(notification.data, {'key': 'value'})
+
+            notifications = SerializerTestMessage.trigger_many([factories.User()], data={'key': 'value'})
+            self.assertEqual(Notification.objects.get(pk=notifications[0].pk).data, {'key': 'value'})
+
+    def test_migrate_notification_data(self):
+
+        pickled = SerializerTestMessage.trigger(factories.User(), data={'key': 'value'})
+        empty = SerializerTestMessage.trigger(factories.User())
+        Notification.objects.filter(pk=empty.pk).update(data_pickled='')
+
+        call_command('migrate_notification_data', to='binary', batch_size=1, stdout=StringIO())
+        notification = Notification.objects.get(pk=pickled.pk)
+        self.assertEqual(notification.data_pickled, '')
+        self.assertEqual(notification.data, {'key': 'value'})
+        self.assertIsNone(Notification.objects.get(pk=empty.pk).data_binary)
+
+        call_command('migrate_notification_data', to='pickled', stdout=StringIO())
+        notification = Notification.objects.get(pk=pickled.pk)
+        self.assertIsNone(notification.data_binary)
+        self.assertEqual(notification.data, {'key': 'value'})
+
+    def test_benchmark_serializers(self):
+
+        SerializerTestMessage.trigger(factories.User(), data={'key': 'value'})
+        # Not JSON serializable
+        SerializerTestMessage.trigger(factories.User(), data={'key': set([1])})
+
+        out = StringIO()
+        call_command('benchmark_serializers', sample=10, repeat=2, stdout=out, stderr=StringIO())
+        report = json.loads(out.getvalue())
+
+        self.assertEqual(report['source'], 'notifications')
+        self.assertEqual(report['payloads'], 2)
+        serializers = dict((entry['name'], entry) for entry in report['serializers'])
+        self.assertEqual(serializers['pickle']['payloads'], 2)
+        self.assertEqual(serializers['json']['payloads'], 1)
+        self.assertEqual(serializers['json']['errors'], 1)
+        self.assertGreater(serializers['pickle']['base64_size_bytes'], serializers['pickle']['size_bytes'])
+
+    @unittest.skipIf(benchmark_serializers.tracemalloc is None, 'tracemalloc is not available')
+    def test_benchmark_serializers_not_traced(self):
+
+        tracing = []
+        now = time.time
+
+        def clock():
+            tracing.append(benchmark_serializers.tracemalloc.is_tracing())
+            return now()
+
+        out = StringIO()
+        with mock.patch.object(benchmark_serializers.time, 'time', side_effect=clock):
+            call_command('benchmark_serializers', repeat=1, stdout=out, stderr=StringIO())
+
+        # Timed loops run without tracing allocations, which is measured in a separate pass
+        self.assertTrue(tracing)
+        self.assertFalse(any(tracing))
+        report = json.loads(out.getvalue())
+        self.assertTrue(all(entry['peak_memory_bytes'] > 0 for entry in report['serializers']))
@@ -1,13 +1,18 @@
 import logging
 
+import mock
 from django.core import mail
+from django.db import connection, transaction
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
 from transmissions import tasks, message
 from transmissions.channels import Channel
 from transmissions.channels.email import DefaultEmailMessage
-from transmissions.models import Notification
+from transmissions.dispatch import get_cursor, set_cursor
+from transmissions.lock import lock
+from transmissions.models import Notification, NotificationQuerySet
 from . import factories
 
 try:
@@ -31,6 +36,25 @@ class BrokenMessage(DefaultEmailMessage):
         super(BrokenMessage, self).__init__(notification)
         raise Exception('This message is broken at init')
 
+@message('task_test_on_commit', behavior=None, subject=TRIGGER_SUBJECT, dispatch_on_commit=True)
+class OnCommitMessage(DefaultEmailMessage):
+    template_name = 'test'
+
+@message('task_test_urgent', behavior=None, subject=TRIGGER_SUBJECT, priority=10, queue='transactional')
+class UrgentMessage(DefaultEmailMessage):
+    template_name = 'test'
+
+
+@message('task_test_weighted', behavior=None, subject=TRIGGER_SUBJECT, weight=2)
+class WeightedMessage(DefaultEmailMessage):
+    template_name = 'test'
+
+
+@message('task_test_quota', behavior=None, subject=TRIGGER_SUBJECT, quota=1)
+class QuotaMessage(DefaultEmailMessage):
+    template_name = 'test'
+
+
 class TasksTests(TestCase):
 
     def setUp(self):
@@ -251,4 +275,340 @@ class TasksTests(TestCase):
         self.assertGreaterEqual(notification.datetime_processed, notification.datetime_scheduled)
 
         # Check email was sent
-        self.assertEqual(len(mail.outbox), 0)
\ No newline at end of file
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_process_all_notifications_batched(self):
+
+        with self.settings(TRANSMISSIONS_TRIGGERS=self.trigger_settings, TRANSMISSIONS_BATCH_SIZE=3):
+            users = [factories.User() for i in xrange(7)]
+            notifications = [TaskTestMessage.trigger(user) for user in users]
+
+            # Trigger task to process all remaining notifications in chunks
+            with mock.patch.object(tasks.process_notifications, 'delay',
+                                   side_effect=tasks.process_notifications) as mock_delay:
+                processed_count = tasks.process_all_notifications()
+            self.assertEqual(processed_count, len(notifications))
+            self.assertEqual([len(call[0][0]) for call in mock_delay.call_args_list], [3, 3, 1])
+
+            # Check status
+            for notification in notifications:
+                notification = Notification.objects.get(pk=notification.id)
+                self.assertEqual(notification.status, Notification.Status.SUCCESSFULLY_SENT)
+                self.assertGreaterEqual(notification.datetime_processed, notification.datetime_scheduled)
+
+            # Check email was sent
+            self.assertEqual(len(mail.outbox), len(notifications))
+
+            # Trigger task ... again
+            processed_count = tasks.process_all_notifications()
+            self.assertEqual(processed_count, 0)
+            self.assertEqual(len(mail.outbox), len(notifications))
+
+    def test_process_notifications_skips_locked(self):
+
+        users = [factories.User() for i in xrange(2)]
+        notifications = [TaskTestMessage.trigger(user) for user in users]
+
+        # Another worker is processing the first notification
+        with lock('{0}'.format(notifications[0].id)):
+            tasks.process_notifications([notification.id for notification in notifications])
+
+        self.assertEqual(Notification.objects.get(pk=notifications[0].id).status, Notification.Status.CREATED)
+        self.assertEqual(Notification.objects.get(pk=notifications[1].id).status,
+                         Notification.Status.SUCCESSFULLY_SENT)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_process_notifications_broken(self):
+
+        user = factories.User()
+        broken_notification = BrokenMessage.trigger(user)
+        notification = TaskTestMessage.trigger(user)
+
+        # Broken notification does not hold back the rest of the chunk
+        tasks.process_notifications([broken_notification.id, notification.id])
+
+        self.assertEqual(Notification.objects.get(pk=broken_notification.id).status, Notification.Status.BROKEN)
+        self.assertEqual(Notification.objects.get(pk=notification.id).status,
+                         Notification.Status.SUCCESSFULLY_SENT)
+        self.assertEqual(len(mail.outbox), 1)
+
+    @mock.patch.object(NotificationQuerySet, 'select_for_update', lambda self, **kwargs: self)
+    @mock.patch('transmissions.models.skip_locked_supported', return_value=True)
+    def test_process_notifications_claimed(self, mock_skip_locked_supported):
+
+        users = [factories.User() for i in xrange(3)]
+        notifications = [TaskTestMessage.trigger(user) for user in users]
+
+        # Another worker claimed the first notification
+        Notification.objects.filter(pk=notifications[0].id).claim()
+
+        with mock.patch('transmissions.tasks.acquire_lock') as mock_acquire_lock:
+            tasks.process_notification(notifications[1].id)
+            tasks.process_notifications([notification.id for notification in notifications])
+        self.assertFalse(mock_acquire_lock.called)
+
+        self.assertEqual(Notification.objects.get(pk=notifications[0].id).status, Notification.Status.PROCESSING)
+        for notification in notifications[1:]:
+            self.assertEqual(Notification.objects.get(pk=notification.id).status,
+                             Notification.Status.SUCCESSFULLY_SENT)
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_process_all_notifications_leased(self):
+
+        user = factories.User()
+        notification = TaskTestMessage.trigger(user)
+
+        # Dispatched notification is still waiting in the broker
+        with mock.patch.object(tasks.process_notification, 'delay') as mock_delay:
+            self.assertEqual(tasks.process_all_notifications(), 1)
+            mock_delay.assert_called_once_with(notification.id)
+
+            # It is not dispatched again until the lease expires
+            self.assertEqual(tasks.process_all_notifications(), 0)
+
+            Notification.objects.filter(pk=notification.id)\
+                .update(datetime_lease_expires=timezone.now() - timezone.timedelta(seconds=1))
+            self.assertEqual(tasks.process_all_notifications(), 1)
+
+    def test_process_notification_crashed_worker(self):
+
+        user = factories.User()
+        notification = TaskTestMessage.trigger(user)
+
+        # Worker claimed the notification and died while sending it
+        with lock('{0}'.format(notification.id)):
+            claimed = Notification.objects.filter(pk=notification.id).claim()
+        self.assertEqual(claimed[0].status, Notification.Status.PROCESSING)
+        self.assertTrue(claimed[0].claimed_by)
+        self.assertGreater(claimed[0].datetime_lease_expires, timezone.now())
+
+        # Notification is neither dispatched nor processed again while leased
+        self.assertEqual(tasks.process_all_notifications(), 0)
+        tasks.process_notification(notification.id)
+        self.assertEqual(len(mail.outbox), 0)
+
+        # Lease expires
+        Notification.objects.filter(pk=notification.id)\
+            .update(datetime_lease_expires=timezone.now() - timezone.timedelta(seconds=1))
+        self.assertEqual(tasks.process_all_notifications(), 1)
+
+        notification = Notification.objects.get(pk=notification.id)
+        self.assertEqual(notification.status, Notification.Status.SUCCESSFULLY_SENT)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_process_all_notifications_budget(self):
+
+        now = timezone.now()
+        users = [factories.User() for i in xrange(5)]
+        notifications = [TaskTestMessage.trigger(user, datetime_scheduled=now - timezone.timedelta(minutes=10 - i))
+                         for i, user in enumerate(users)]
+        self.addCleanup(set_cursor, None)
+
+        with self.settings(TRANSMISSIONS_DISPATCH_MAX_ROWS=2, TRANSMISSIONS_DISPATCH_CHUNK_SIZE=2):
+            with mock.patch.object(tasks.process_notification, 'delay') as mock_delay:
+                # Budget runs out after 2 notifications
+                self.assertEqual(tasks.process_all_notifications(), 2)
+                self.assertEqual(get_cursor(), (notifications[1].datetime_scheduled, notifications[1].id))
+
+                # A notification scheduled before the cursor is only dispatched after resuming from the cursor
+                earlier = TaskTestMessage.trigger(users[0], datetime_scheduled=now - timezone.timedelta(days=1))
+                self.assertEqual(tasks.process_all_notifications(), 2)
+                self.assertEqual(tasks.process_all_notifications(), 1)
+                self.assertIsNone(get_cursor())
+                self.assertEqual(tasks.process_all_notifications(), 1)
+                self.assertEqual(tasks.process_all_notifications(), 0)
+
+        self.assertEqual([call[0][0] for call in mock_delay.call_args_list],
+                         [notification.id for notification in notifications] + [earlier.id])
+
+    def test_process_all_notifications_time_budget(self):
+
+        users = [factories.User() for i in xrange(3)]
+        notifications = [TaskTestMessage.trigger(user) for user in users]
+        self.addCleanup(set_cursor, None)
+
+        with self.settings(TRANSMISSIONS_DISPATCH_MAX_SECONDS=0, TRANSMISSIONS_DISPATCH_CHUNK_SIZE=2):
+            with mock.patch.object(tasks.process_notification, 'delay') as mock_delay:
+                # Each run dispatches a single chunk, resuming after the previous one
+                self.assertEqual(tasks.process_all_notifications(), 2)
+                self.assertEqual([call[0][0] for call in mock_delay.call_args_list],
+                                 [notification.id for notification in notifications[:2]])
+
+                mock_delay.reset_mock()
+                self.assertEqual(tasks.process_all_notifications(), 1)
+                self.assertEqual([call[0][0] for call in mock_delay.call_args_list], [notifications[2].id])
+                self.assertIsNone(get_cursor())
+
+    def test_process_notification_locked(self):
+
+        user = factories.User()
+        notification = TaskTestMessage.trigger(user)
+
+        # Another worker holds the lock: the task is re-queued without waiting
+        with lock('{0}'.format(notification.id)):
+            with mock.patch.object(tasks.process_notification, 'apply_async') as mock_apply_async, \
+                    mock.patch('time.sleep') as mock_sleep:
+                tasks.process_notification(notification.id)
+                mock_apply_async.assert_called_once_with((notification.id,), {'requeued': 1}, countdown=5)
+
+                # Until it was re-queued too many times
+                mock_apply_async.reset_mock()
+                tasks.process_notification(notification.id, requeued=3)
+                self.assertFalse(mock_apply_async.called)
+
+                # Or skipped right away
+                with self.settings(TRANSMISSIONS_LOCK_REQUEUE_COUNTDOWN=None):
+                    tasks.process_notification(notification.id)
+                self.assertFalse(mock_apply_async.called)
+            self.assertFalse(mock_sleep.called)
+
+        self.assertEqual(Notification.objects.get(pk=notification.id).status, Notification.Status.CREATED)
+
+        # Re-queued task processes the notification once the lock is released
+        tasks.process_notification(notification.id, requeued=1)
+        self.assertEqual(Notification.objects.get(pk=notification.id).status, Notification.Status.SUCCESSFULLY_SENT)
+
+    @mock.patch('django.db.transaction.on_commit', side_effect=lambda func: func())
+    def test_dispatch_on_commit(self, mock_on_commit):
+
+        users = [factories.User() for i in xrange(3)]
+        with mock.patch.object(tasks.process_notification, 'delay') as mock_delay:
+            notification = OnCommitMessage.trigger(users[0])
+            mock_delay.assert_called_once_with(notification.id)
+
+            # Notifications scheduled later, or without the option, wait for the poller
+            mock_delay.reset_mock()
+            OnCommitMessage.trigger(users[0], datetime_scheduled=timezone.now() + timezone.timedelta(days=1))
+            TaskTestMessage.trigger(users[0])
+            self.assertFalse(mock_delay.called)
+
+            # Notifications dispatched already are not dispatched again by the poller
+            self.assertEqual(tasks.process_all_notifications(), 1)
+
+            notifications = OnCommitMessage.trigger_many(users[1:])
+            self.assertEqual(sorted(call[0][0] for call in mock_delay.call_args_list[1:]),
+                             sorted(notification.id for notification in notifications))
+
+    @mock.patch('django.db.transaction.on_commit', side_effect=lambda func: func())
+    def test_dispatch_on_commit_broker_down(self, mock_on_commit):
+
+        user = factories.User()
+        with mock.patch.object(tasks.process_notification, 'delay', side_effect=IOError('Broker is down')):
+            notification = OnCommitMessage.trigger(user)
+
+        # Left to the poller
+        self.assertTrue(Notification.objects.due().filter(pk=notification.id).exists())
+
+    def test_dispatch_on_commit_without_on_commit(self):
+
+        on_commit = transaction.on_commit
+        del transaction.on_commit
+        self.addCleanup(setattr, transaction, 'on_commit', on_commit)
+
+        # Not dispatched within the transaction, which workers do not see yet
+        user = factories.User()
+        with mock.patch.object(tasks.process_notification, 'delay') as mock_delay:
+            notification = OnCommitMessage.trigger(user)
+        self.assertFalse(mock_delay.called)
+        self.assertTrue(Notification.objects.due().filter(pk=notification.id).exists())
+
+    def test_dispatch_on_commit_process(self):
+
+        user = factories.User()
+        with mock.patch('django.db.transaction.on_commit') as mock_on_commit:
+            notification = OnCommitMessage.trigger(user)
+            self.assertEqual(Notification.objects.get(pk=notification.id).status, Notification.Status.CREATED)
+
+        # Transaction is committed
+        mock_on_commit.call_args[0][0]()
+        self.assertEqual(Notification.objects.get(pk=notification.id).status, Notification.Status.SUCCESSFULLY_SENT)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_process_all_notifications_priority(self):
+
+        now = timezone.now()
+        user = factories.User()
+        notifications = [TaskTestMessage.trigger(user, datetime_scheduled=now - timezone.timedelta(minutes=10 - i))
+                         for i in xrange(2)]
+        urgent = UrgentMessage.trigger(user)
+        self.addCleanup(set_cursor, None)
+
+        with self.settings(TRANSMISSIONS_DISPATCH_MAX_ROWS=2):
+            with mock.patch.object(tasks.process_notification, 'delay') as mock_delay, \
+                    mock.patch.object(tasks.process_notification, 'apply_async') as mock_apply_async:
+                # Urgent notification is dispatched first, to its queue
+                self.assertEqual(tasks.process_all_notifications(), 2)
+                mock_apply_async.assert_called_once_with((urgent.id,), queue='transactional')
+                mock_delay.assert_called_once_with(notifications[0].id)
+
+                self.assertEqual(tasks.process_all_notifications(), 1)
+                mock_delay.assert_called_with(notifications[1].id)
+
+    def test_dispatch_queue_batched(self):
+
+        notifications = [UrgentMessage.trigger(factories.User()) for i in xrange(3)]
+
+        with self.settings(TRANSMISSIONS_BATCH_SIZE=2):
+            with mock.patch.object(tasks.process_notifications, 'apply_async') as mock_apply_async:
+                self.assertEqual(tasks.process_all_notifications(), 3)
+
+        self.assertEqual(mock_apply_async.call_args_list,
+                         [mock.call(([notification.id for notification in notifications[:2]],), queue='transactional'),
+                          mock.call(([notifications[2].id],), queue='transactional')])
+
+    def test_process_all_notifications_fair_share(self):
+
+        now = timezone.now()
+        user = factories.User()
+        campaign = [TaskTestMessage.trigger(user, datetime_scheduled=now - timezone.timedelta(minutes=10))
+                    for i in xrange(4)]
+        weighted = [WeightedMessage.trigger(user) for i in xrange(3)]
+        quota = [QuotaMessage.trigger(user) for i in xrange(2)]
+
+        with self.settings(TRANSMISSIONS_DISPATCH_FAIR_SHARE=True, TRANSMISSIONS_DISPATCH_FAIR_SHARE_SLICE=1):
+            with mock.patch.object(tasks.process_notification, 'delay') as mock_delay:
+                self.assertEqual(tasks.process_all_notifications(), 8)
+
+                # Triggers take turns, the oldest first
+                self.assertEqual([call[0][0] for call in mock_delay.call_args_list],
+                                 [campaign[0].id, weighted[0].id, weighted[1].id, quota[0].id,
+                                  campaign[1].id, weighted[2].id,
+                                  campaign[2].id,
+                                  campaign[3].id])
+
+                # Next run
+                mock_delay.reset_mock()
+                self.assertEqual(tasks.process_all_notifications(), 1)
+                mock_delay.assert_called_once_with(quota[1].id)
+
+    def test_process_all_notifications_fair_share_queries(self):
+
+        user = factories.User()
+        notification = TaskTestMessage.trigger(user)
+        unregistered = TaskTestMessage.trigger(user)
+        Notification.objects.filter(pk=unregistered.id).update(trigger_name='unregistered')
+
+        with self.settings(TRANSMISSIONS_DISPATCH_FAIR_SHARE=True), \
+                CaptureQueriesContext(connection) as queries:
+            with mock.patch.object(tasks.process_notification, 'delay') as mock_delay:
+                self.assertEqual(tasks.process_all_notifications(), 2)
+
+        # Triggers are ordered without aggregating the backlog, unregistered triggers take the last turn
+        self.assertFalse([query['sql'] for query in queries.captured_queries if 'GROUP BY' in query['sql']])
+        self.assertEqual([call[0][0] for call in mock_delay.call_args_list], [notification.id, unregistered.id])
+
+    def test_process_all_notifications_fair_share_budget(self):
+
+        now = timezone.now()
+        user = factories.User()
+        campaign = [TaskTestMessage.trigger(user, datetime_scheduled=now - timezone.timedelta(minutes=10))
+                    for i in xrange(4)]
+        weighted = WeightedMessage.trigger(user)
+
+        with self.settings(TRANSMISSIONS_DISPATCH_FAIR_SHARE=True, TRANSMISSIONS_DISPATCH_FAIR_SHARE_SLICE=1,
+                           TRANSMISSIONS_DISPATCH_MAX_ROWS=2):
+            with mock.patch.object(tasks.process_notification, 'delay') as mock_delay:
+                self.assertEqual(tasks.process_all_notifications(), 2)
+
+        # The backlog of the campaign does not hold back the other trigger
+        self.assertEqual([call[0][0] for call in mock_delay.call_args_list], [campaign[0].id, weighted.id])
@@ -3,3 +3,5 @@ from transmissions.trigger import message
 __all__ = ('trigger', 'Notification', 'Channel', 'message')
 
 __version__ = (0, 2, 2)
+
+default_app_config = 'transmissions.apps.TransmissionsConfig'
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+"""
+    django-transmissions.apps
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Application configuration
+"""
+from django.apps import AppConfig
+
+
+class TransmissionsConfig(AppConfig):
+    name = 'transmissions'
+    verbose_name = 'Transmissions'
+
+    def ready(self):
+        # Register all messages at startup, so that workers can process any notification
+        from transmissions.trigger import autodiscover
+        autodiscover()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+    django-transmissions.breaker
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Circuit breakers per provider, shared by workers through the Django cache.
+
+    A circuit opens after `TRANSMISSIONS_CIRCUIT_FAILURES` consecutive failed sends to a provider, and stays open
+    for `TRANSMISSIONS_CIRCUIT_RESET_SECONDS`. It then half-opens: a single worker sends a probe, which closes the
+    circuit if it succeeds or opens it again if it fails.
+
+    When the cache is unavailable, circuits are considered closed so that messages are still sent.
+"""
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.key = 'transmissions-circuit-{}'.format(provider)
+        self.failures = 0
+        self.opened_until = None
+        self.probing = False
+
+    @classmethod
+    def for_message(cls, message_class):
+        return cls(cls.provider_of(message_class))
+
+    @staticmethod
+    def provider_of(message_class):
+        """ The `provider` attribute of the message class, or the class defining its `send()` method """
+        provider = getattr(message_class, 'provider', None)
+        if provider:
+            return provider
+        for klass in message_class.__mro__:
+            if 'send' in vars(klass):
+                return '{}.{}'.format(klass.__module__, klass.__name__)
+        return '{}.{}'.format(message_class.__module__, message_class.__name__)
+
+    @property
+    def threshold(self):
+        return getattr(settings, 'TRANSMISSIONS_CIRCUIT_FAILURES', 5)
+
+    @property
+    def reset_seconds(self):
+        return getattr(settings, 'TRANSMISSIONS_CIRCUIT_RESET_SECONDS', 60)
+
+    def allow(self):
+        """ Whether messages can be sent to the provider
+
+        When the circuit is half-open, only the worker sending the probe is allowed, with `probing` set.
+        """
+        self.probing = False
+        if self.threshold is None:
+            return True
+
+        try:
+            values = cache.get_many([self.key + '-open', self.key + '-failures'])
+            self.opened_until = values.get(self.key + '-open')
+            self.failures = values.get(self.key + '-failures') or 0
+            if self.opened_until is not None and self.opened_until > time.time():
+                return False
+            if self.failures < self.threshold:
+                return True
+
+            self.probing = cache.add(self.key + '-probe', True, self.reset_seconds)
+            return self.probing
+        except Exception as e:
+            logging.getLogger('django-transmissions').warning('Circuit breaker cache unavailable: %r', e)
+            self.opened_until = None
+            self.failures = 0
+            self.probing = False
+            return True
+
+    def retry_after(self):
+        """ Seconds after which messages denied by `allow()` should be sent again """
+        if self.opened_until is not None:
+            return max(self.opened_until - time.time(), 1)
+        # Half-open, another worker is sending the probe
+        return self.reset_seconds
+
+    def success(self):
+        if self.failures or self.probing:
+            try:
+                cache.delete_many([self.key + '-failures', self.key + '-probe'])
+            except Exception as e:
+                logging.getLogger('django-transmissions').warning('Circuit breaker cache unavailable: %r', e)
+        self.failures = 0
+        self.probing = False
+
+    def failure(self, count=1):
+        """ Record failed sends
+
+        :return: time until which the circuit is open, if these failures opened it
+        """
+        if self.threshold is None:
+            return None
+
+        try:
+            try:
+                self.failures = cache.incr(self.key + '-failures', count)
+            except ValueError:
+                cache.set(self.key + '-failures', count, None)
+                self.failures = count
+
+            if self.failures < self.threshold:
+                return None
+
+            self.opened_until = time.time() + self.reset_seconds
+            cache.set(self.key + '-open', self.opened_until, self.reset_seconds)
+            cache.delete(self.key + '-probe')
+        except Exception as e:
+            logging.getLogger('django-transmissions').warning('Circuit breaker cache unavailable: %r', e)
+            return None
+        self.probing = False
+        return self.opened_until
+
+    def record(self, errors):
+        """ Record the outcome of sends, in order: None if sent or the error
+
+        :return: time until which the circuit is open, if the failures opened it
+        """
+        trailing = 0
+        for error in reversed(errors):
+            if error is None:
+                break
+            trailing += 1
+
+        if trailing < len(errors):
+            self.success()
+        if trailing:
+            return self.failure(trailing)
+        return None
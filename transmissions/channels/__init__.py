@@ -7,18 +7,26 @@
 
 """
 import logging
+import os
+import threading
 
-from django.utils.module_loading import import_string
 from transmissions.exceptions import UnknownTriggerException, ChannelSendException
+from transmissions.trigger import register
 from transmissions.utils import EnumDict
 
 
 class Channel(object):
 
+    # Message classes set up in this process, and the process id they were set up in
+    _setup_classes = set()
+    _setup_pid = None
+    _setup_lock = threading.RLock()
+
     def __init__(self, notification):
         self.notification = notification
 
         template_class = self.get_template()
+        self.setup_message(template_class)
         self.message = template_class(self.notification)
 
     class Types(EnumDict):
@@ -27,18 +35,69 @@ class Channel(object):
 
     def get_template(self):
 
-        # Dynamically load template class
-        from transmissions.trigger import register
-        if self.notification.trigger_name in register:
-            return import_string(register[self.notification.trigger_name])
-
-        raise UnknownTriggerException()
+        try:
+            return register[self.notification.trigger_name]
+        except KeyError:
+            raise UnknownTriggerException()
+
+    @staticmethod
+    def lifecycle_class(message_class):
+        """ Class defining the `setup()` hook of `message_class`, which subclasses share """
+        for klass in message_class.__mro__:
+            if 'setup' in vars(klass):
+                return klass
+        return None
+
+    @classmethod
+    def setup_message(cls, message_class):
+        """ Run the `setup()` hook of `message_class` once per process
+
+        Clients set up before the process was forked are not shared with the child, which sets up its own.
+        """
+        klass = cls.lifecycle_class(message_class)
+        if klass is None:
+            return
+
+        with cls._setup_lock:
+            if cls._setup_pid != os.getpid():
+                cls._setup_classes.clear()
+                cls._setup_pid = os.getpid()
+            if klass not in cls._setup_classes:
+                klass.setup()
+                cls._setup_classes.add(klass)
+
+    @classmethod
+    def setup(cls):
+        """ Set up all registered message classes, e.g. when a worker process starts """
+        for message_class in list(register.values()):
+            try:
+                cls.setup_message(message_class)
+            except Exception as e:
+                # Set up again on first use
+                logging.getLogger('django-transmissions').exception(e)
+
+    @classmethod
+    def teardown(cls):
+        """ Run the `teardown()` hook of message classes set up in this process, e.g. when a worker shuts down """
+        with cls._setup_lock:
+            if cls._setup_pid == os.getpid():
+                for klass in cls._setup_classes:
+                    if hasattr(klass, 'teardown'):
+                        try:
+                            klass.teardown()
+                        except Exception as e:
+                            logging.getLogger('django-transmissions').exception(e)
+            cls._setup_classes.clear()
 
     def check_validity(self):
         """ Method called just before send() to determine if notification should still be sent
 
+        Messages implementing `check_validity_many(notifications)` are checked with it, as when processed in batches.
+
         :return: True if still valid, False if notification should be cancelled
         """
+        if hasattr(self.message, 'check_validity_many'):
+            return self.notification in self.message.check_validity_many([self.notification])
         return not hasattr(self.message, 'check_validity') or self.message.check_validity()
 
     def send(self):
@@ -53,3 +112,42 @@ class Channel(object):
         except Exception as e:
             logging.getLogger('django-transmissions').exception(e)
             raise ChannelSendException()
+
+    @classmethod
+    def send_many(cls, channels):
+        """ Send notifications of the same trigger together
+
+        Messages implementing `send_many(messages)` send them at once, e.g. over a single connection. Other messages
+        are sent one at a time.
+
+        :param channels: channels of notifications with the same trigger
+        :return: for each channel, None if sent or the `ChannelSendException`
+        """
+
+        logger = logging.getLogger('django-transmissions')
+
+        message_class = channels[0].message.__class__
+        if hasattr(message_class, 'send_many'):
+            try:
+                results = message_class.send_many([channel.message for channel in channels])
+            except Exception as e:
+                logger.exception(e)
+                results = [e] * len(channels)
+        else:
+            results = []
+            for channel in channels:
+                try:
+                    channel.message.send()
+                    results.append(None)
+                except Exception as e:
+                    logger.exception(e)
+                    results.append(e)
+
+        errors = []
+        for channel, result in zip(channels, results):
+            if result is None:
+                errors.append(None)
+            else:
+                logger.error('Notification #%s could not be sent: %r', channel.notification.pk, result)
+                errors.append(ChannelSendException(*result.args))
+        return errors
@@ -6,11 +6,20 @@
     Mandrill email channel
 
 """
-from django.core.mail import EmailMessage
+import logging
+from smtplib import SMTPServerDisconnected
+
+from django.core.mail import EmailMessage, get_connection
+from transmissions.channels import Channel
 
 
 class DefaultEmailMessage(object):
 
+    channel_type = Channel.Types.EMAIL
+
+    # Email backend connection kept open by the worker process, see `setup()`
+    connection = None
+
     def __init__(self, notification):
         self.to = notification.target_user
         self.subject = self.kwargs.get('subject')
@@ -24,8 +33,61 @@ class DefaultEmailMessage(object):
         msg = EmailMessage(self.subject, body=self.body, to=[self.to.email])
         return msg
 
+    @classmethod
+    def setup(cls):
+        """ Open an email backend connection reused by all emails sent by this process """
+        DefaultEmailMessage.connection = get_connection()
+        try:
+            DefaultEmailMessage.connection.open()
+        except Exception as e:
+            # Opened when sending the next email
+            logging.getLogger('django-transmissions').exception(e)
+
+    @classmethod
+    def teardown(cls):
+        if DefaultEmailMessage.connection is not None:
+            DefaultEmailMessage.connection.close()
+            DefaultEmailMessage.connection = None
+
     def send(self):
-        self.create_message().send()
+        msg = self.create_message()
+        msg.connection = self.connection
+        try:
+            msg.send()
+        except SMTPServerDisconnected:
+            if msg.connection is None:
+                raise
+            # The server closed the idle connection, reconnect once
+            msg.connection.close()
+            msg.connection.open()
+            msg.send()
+
+    @classmethod
+    def send_many(cls, messages):
+        """ Send messages over a single email backend connection
+
+        :return: for each message, None if sent or the exception raised
+        """
+
+        connection = DefaultEmailMessage.connection
+        close = connection is None
+        if close:
+            connection = get_connection()
+            connection.open()
+
+        results = []
+        try:
+            for message in messages:
+                message.connection = connection
+                try:
+                    message.send()
+                    results.append(None)
+                except Exception as e:
+                    results.append(e)
+        finally:
+            if close:
+                connection.close()
+        return results
 
     def check_validity(self):
         """ Email is valid and can be sent """
@@ -1,7 +1,12 @@
 
 
+from transmissions.channels import Channel
+
+
 class DefaultSMSMessage(object):
 
+    channel_type = Channel.Types.SMS
+
     def __init__(self, notification):
         self.to = notification.target_user
         self.subject = self.kwargs.get('subject')
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+    django-transmissions.dispatch
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Scanning of due notifications by the dispatcher
+"""
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+
+from transmissions.trigger import register
+
+CURSOR_KEY = 'transmissions-dispatch-cursor'
+
+
+def get_cursor_key(priority=0):
+    """ Cache key of the cursor of a priority tier """
+    return CURSOR_KEY if not priority else '{}-{}'.format(CURSOR_KEY, priority)
+
+
+def get_option(trigger_name, name, default=None):
+    """ Value of the `name` kwarg of the message of a trigger """
+    message_class = register.get(trigger_name)
+    return getattr(message_class, 'kwargs', {}).get(name, default)
+
+
+def get_priority(trigger_name):
+    """ Priority of a trigger, from the `priority` kwarg of its message. Default: 0 """
+    return get_option(trigger_name, 'priority', 0)
+
+
+def get_queue(trigger_name):
+    """ Celery queue of a trigger, from the `queue` kwarg of its message. Default: None, Celery's default queue """
+    return get_option(trigger_name, 'queue')
+
+
+def prioritize(queryset):
+    """ Split `queryset` by priority of the triggers
+
+    Notifications of triggers with no priority, or which are not registered, have priority 0.
+
+    :return: list of `(priority, queryset)`, highest priority first
+    """
+    tiers = {0: []}
+    for trigger_name in register:
+        tiers.setdefault(get_priority(trigger_name), []).append(trigger_name)
+
+    prioritized = [trigger_name for priority, trigger_names in tiers.items() if priority
+                   for trigger_name in trigger_names]
+
+    querysets = []
+    for priority in sorted(tiers, reverse=True):
+        if priority:
+            querysets.append((priority, queryset.filter(trigger_name__in=tiers[priority])))
+        elif prioritized:
+            querysets.append((priority, queryset.exclude(trigger_name__in=prioritized)))
+        else:
+            querysets.append((priority, queryset))
+    return querysets
+
+
+def get_cursor(key=CURSOR_KEY):
+    """ Position `(datetime_scheduled, id)` where the previous run stopped, if it ran out of budget """
+    return cache.get(key)
+
+
+def set_cursor(cursor, key=CURSOR_KEY):
+    if cursor is None:
+        cache.delete(key)
+    else:
+        cache.set(key, cursor, None)
+
+
+def scan(queryset, cursor=None, chunk_size=500, fields=()):
+    """ Stream `queryset` in chunks of `(datetime_scheduled, id)` tuples, ordered by `(datetime_scheduled, id)`
+
+    Chunks are keyset-paginated so that each query only reads the rows it returns.
+
+    :param cursor: `(datetime_scheduled, id)` of the row to resume after
+    :param fields: additional fields appended to the tuples
+    """
+    while True:
+        chunk_queryset = queryset
+        if cursor is not None:
+            chunk_queryset = chunk_queryset.filter(Q(datetime_scheduled__gt=cursor[0]) |
+                                                   Q(datetime_scheduled=cursor[0], id__gt=cursor[1]))
+
+        rows = list(chunk_queryset.order_by('datetime_scheduled', 'id')
+                    .values_list('datetime_scheduled', 'id', *fields)[:chunk_size])
+        if rows:
+            yield rows
+        if len(rows) < chunk_size:
+            return
+        cursor = rows[-1][:2]
+
+
+def interleave(queryset, slice_size=100):
+    """ Stream `queryset` in turns of `(datetime_scheduled, id, trigger_name)` tuples, one trigger at a time
+
+    Triggers take turns, starting with the one with the oldest notification. Each turn, a trigger gets `slice_size`
+    notifications times the `weight` kwarg of its message (default: 1), until it reaches the `quota` kwarg
+    of its message (default: no quota) or has no notification left. Notifications of triggers which are not
+    registered take the last turn.
+
+    Triggers are ordered with one indexed query per registered trigger, rather than by aggregating the backlog.
+    """
+
+    def oldest(trigger_queryset):
+        return trigger_queryset.order_by('datetime_scheduled').values_list('datetime_scheduled', flat=True).first()
+
+    triggers = []
+    for trigger_name in register:
+        datetime_scheduled = oldest(queryset.filter(trigger_name=trigger_name))
+        if datetime_scheduled is not None:
+            triggers.append((datetime_scheduled, trigger_name))
+
+    scans = OrderedDict()
+    quotas = {}
+    for _, trigger_name in sorted(triggers):
+        size = max(1, int(slice_size * get_option(trigger_name, 'weight', 1)))
+        scans[trigger_name] = scan(queryset.filter(trigger_name=trigger_name), chunk_size=size,
+                                   fields=('trigger_name',))
+        quotas[trigger_name] = get_option(trigger_name, 'quota')
+
+    unregistered = queryset.exclude(trigger_name__in=list(register))
+    if oldest(unregistered) is not None:
+        scans[None] = scan(unregistered, chunk_size=slice_size, fields=('trigger_name',))
+        quotas[None] = None
+
+    while scans:
+        for trigger_name in list(scans):
+            rows = next(scans[trigger_name], [])
+            if quotas[trigger_name] is not None:
+                rows = rows[:quotas[trigger_name]]
+                quotas[trigger_name] -= len(rows)
+            if not rows or quotas[trigger_name] == 0:
+                del scans[trigger_name]
+            if rows:
+                yield rows
+
+
+class Budget(object):
+    """ Number of rows and time a dispatcher run may spend """
+
+    def __init__(self, max_rows=None, max_seconds=None):
+        self.rows_left = max_rows
+        self.deadline = time.time() + max_seconds if max_seconds is not None else None
+
+    @classmethod
+    def from_settings(cls):
+        return cls(getattr(settings, 'TRANSMISSIONS_DISPATCH_MAX_ROWS', None),
+                   getattr(settings, 'TRANSMISSIONS_DISPATCH_MAX_SECONDS', 45))
+
+    def spend(self, rows):
+        if self.rows_left is not None:
+            self.rows_left -= rows
+
+    def limit(self, rows):
+        """ Trim `rows` to what is left in the budget """
+        return rows if self.rows_left is None else rows[:self.rows_left]
+
+    @property
+    def exhausted(self):
+        return ((self.rows_left is not None and self.rows_left <= 0) or
+                (self.deadline is not None and time.time() >= self.deadline))
@@ -5,6 +5,7 @@
 
     This module contains all exceptions used by the Django Transmissions module
 """
+from django.core.exceptions import ImproperlyConfigured
 
 
 class DuplicateNotification(Exception):
@@ -14,4 +15,10 @@ class ChannelSendException(Exception):
     """ Notification could not be sent through this channel """
 
 class UnknownTriggerException(Exception):
-    """ Notification's trigger is not defined """
\ No newline at end of file
+    """ Notification's trigger is not defined """
+
+class DuplicateTriggerException(ImproperlyConfigured):
+    """ Two messages are defined with the same trigger name """
+
+class LockTimeout(RuntimeError):
+    """ Lock could not be acquired in time """
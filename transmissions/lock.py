@@ -1,27 +1,184 @@
-from django.core.cache import cache
+# -*- coding: utf-8 -*-
+"""
+    django-transmissions.lock
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Locks on notification and trigger keys, with pluggable backends:
+       * `CacheLockBackend`: Django cache, the default
+       * `DatabaseLockBackend`: PostgreSQL or MySQL advisory locks
+       * `LocalLockBackend`: in-process locks, for single-node deployments
+"""
 import contextlib
+import hashlib
+import random
+import threading
 import time
+import uuid
 
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.utils.module_loading import import_string
 
-@contextlib.contextmanager
-def lock(key, timeout=5000):
+from transmissions.exceptions import LockTimeout
+
+
+class BaseLockBackend(object):
+
+    def acquire(self, lock_id, token, ttl):
+        """ Try once to acquire the lock
+
+        :param token: unique to this acquisition, identifies the owner of the lock
+        :param ttl: seconds after which the lock expires if not released
+        :return: True if the lock was acquired
+        """
+        raise NotImplementedError()
+
+    def release(self, lock_id, token):
+        """ Release the lock, unless it expired and is now owned by someone else """
+        raise NotImplementedError()
+
+
+class CacheLockBackend(BaseLockBackend):
+
+    def acquire(self, lock_id, token, ttl):
+        return cache.add(lock_id, token, ttl)
+
+    def release(self, lock_id, token):
+        # Compare and delete
+        if cache.get(lock_id) == token:
+            cache.delete(lock_id)
+
+
+class DatabaseLockBackend(BaseLockBackend):
     """
-    A simple context manager that raises the passed exception
-    if a lock can't be acquired.
+    Session-level advisory locks, released when the database connection closes rather than after `ttl`
+    """
+
+    def acquire(self, lock_id, token, ttl):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute('SELECT pg_try_advisory_lock(%s)', [self.advisory_key(lock_id)])
+            elif connection.vendor == 'mysql':
+                cursor.execute('SELECT GET_LOCK(%s, 0)', [lock_id[:64]])
+            else:
+                raise ImproperlyConfigured('Database locks are not supported by {}'.format(connection.vendor))
+            return bool(cursor.fetchone()[0])
+
+    def release(self, lock_id, token):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute('SELECT pg_advisory_unlock(%s)', [self.advisory_key(lock_id)])
+            else:
+                cursor.execute('SELECT RELEASE_LOCK(%s)', [lock_id[:64]])
+
+    @staticmethod
+    def advisory_key(lock_id):
+        """ Signed 64 bits integer key for PostgreSQL advisory locks """
+        return int(hashlib.sha1(lock_id.encode()).hexdigest()[:15], 16)
+
+
+class LocalLockBackend(BaseLockBackend):
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.locks = {}
+
+    def acquire(self, lock_id, token, ttl):
+        now = time.time()
+        with self.mutex:
+            owner = self.locks.get(lock_id)
+            if owner is not None and owner[1] > now:
+                return False
+            self.locks[lock_id] = (token, now + ttl)
+            return True
+
+    def release(self, lock_id, token):
+        with self.mutex:
+            owner = self.locks.get(lock_id)
+            if owner is not None and owner[0] == token:
+                del self.locks[lock_id]
+
+
+class LockStats(object):
+    """ Lock contention counters for this process """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.acquisitions = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_ms = 0
+
+    def snapshot(self):
+        return {'acquisitions': self.acquisitions, 'waits': self.waits,
+                'timeouts': self.timeouts, 'wait_ms': self.wait_ms}
+
+stats = LockStats()
+
+_backends = {}
+
+
+def get_backend():
+    path = getattr(settings, 'TRANSMISSIONS_LOCK_BACKEND', 'transmissions.lock.CacheLockBackend')
+    if path not in _backends:
+        _backends[path] = import_string(path)()
+    return _backends[path]
+
+
+def acquire_lock(key, timeout=5000, ttl=None):
+    """
+    Acquire the lock for `key`, retrying with exponential backoff and jitter for up to `timeout` milliseconds.
+
+    :param ttl: seconds after which the lock expires if not released
+    :return: handle to be passed to `release_lock()`
     """
 
     lock_id = 'lock-transmission-{0}'.format(key)
-    acquire_lock = lambda: cache.add(lock_id, 1, 90) # fix to keep the key for 90secs in redis instead of 5000sec
-    release_lock = lambda: cache.delete(lock_id)
+    token = uuid.uuid4().hex
+    if ttl is None:
+        ttl = getattr(settings, 'TRANSMISSIONS_LOCK_TTL', 90)
+    backend = get_backend()
+
+    start = time.time()
+    delay = 10
+    while not backend.acquire(lock_id, token, ttl):
+        waited = int((time.time() - start) * 1000)
+        if waited >= timeout:
+            stats.timeouts += 1
+            stats.wait_ms += waited
+            raise LockTimeout('Lock could not be acquired after {}ms'.format(waited))
+
+        # Sleep between half and all of the current delay, without going past the timeout
+        time.sleep(min(delay * random.uniform(0.5, 1), timeout - waited) / 1000.0)
+        delay = min(delay * 2, 500)
+
+    waited = int((time.time() - start) * 1000)
+    stats.acquisitions += 1
+    if waited:
+        stats.waits += 1
+        stats.wait_ms += waited
+
+    return lock_id, token
+
 
-    waited, hops = 0, 10
-    while not acquire_lock():
-        time.sleep(float(hops) / 1000.0)
-        waited += hops
-        if waited > timeout:
-            raise RuntimeError('Lock could not be acquired after {}ms'.format(waited))
+def release_lock(handle):
+    lock_id, token = handle
+    get_backend().release(lock_id, token)
+
+
+@contextlib.contextmanager
+def lock(key, timeout=5000, ttl=None):
+    """
+    A simple context manager that raises `LockTimeout`
+    if a lock can't be acquired.
+    """
 
+    handle = acquire_lock(key, timeout, ttl)
     try:
         yield
     finally:
-        release_lock()
+        release_lock(handle)
@@ -0,0 +1,155 @@
+import json
+import platform
+import time
+import zlib
+from base64 import b64encode
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand
+from transmissions import __version__
+from transmissions.models import Notification
+from transmissions.serializer import DefaultSerializer, JSONSerializer, MsgpackSerializer, load_class
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+
+# Used when there are no notifications with data to sample
+SYNTHETIC_PAYLOADS = [
+    {},
+    {'order_id': 12345, 'amount': 19.99, 'currency': 'USD'},
+    {'items': [{'sku': 'SKU-{}'.format(i), 'quantity': i, 'title': 'Item {}'.format(i)} for i in range(50)]},
+    {'body': 'Lorem ipsum dolor sit amet. ' * 200, 'tags': ['a', 'b', 'c'], 'flag': True, 'empty': None},
+]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark data serializers over notifications sampled from the database, and print a JSON report'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sample', action='store', dest='sample', type=int, default=1000,
+                            help='Number of most recent notifications with data to sample')
+        parser.add_argument('--repeat', action='store', dest='repeat', type=int, default=5,
+                            help='Number of times each payload is serialized and deserialized')
+        parser.add_argument('--serializer', action='append', dest='serializers', default=[],
+                            help='Path to an additional serializer class to benchmark, can be repeated')
+        parser.add_argument('--output', action='store', dest='output', default=None,
+                            help='File to write the report to, instead of the standard output')
+
+    def handle(self, sample=1000, repeat=5, serializers=None, output=None, *args, **options):
+
+        payloads = self.sample(sample)
+        source = 'notifications' if payloads else 'synthetic'
+        if not payloads:
+            payloads = SYNTHETIC_PAYLOADS
+
+        report = {
+            'transmissions': '.'.join(str(part) for part in __version__),
+            'python': platform.python_version(),
+            'source': source,
+            'payloads': len(payloads),
+            'repeat': repeat,
+            'serializers': [self.benchmark(name, serializer, payloads, repeat)
+                            for name, serializer in self.get_serializers(serializers or [])],
+        }
+
+        content = json.dumps(report, indent=2, sort_keys=True)
+        if output:
+            with open(output, 'w') as f:
+                f.write(content)
+        else:
+            self.stdout.write(content)
+
+    def sample(self, size):
+
+        payloads = []
+        notifications = (Notification.objects.exclude(data_pickled='', data_binary__isnull=True)
+                         .order_by('-id').only('id', 'data_pickled', 'data_binary'))
+        for notification in notifications[:size]:
+            try:
+                payloads.append(notification.data)
+            except Exception:
+                continue
+        return payloads
+
+    def get_serializers(self, paths):
+
+        serializers = [('pickle', 'transmissions.serializer.DefaultSerializer', DefaultSerializer)]
+        configured = getattr(settings, 'TRANSMISSIONS_SERIALIZER', None)
+        if configured:
+            serializers.append(('configured', configured, load_class(configured)))
+        serializers.append(('json', 'transmissions.serializer.JSONSerializer', JSONSerializer))
+        serializers.append(('msgpack', 'transmissions.serializer.MsgpackSerializer', MsgpackSerializer))
+        serializers.extend((path, path, load_class(path)) for path in paths)
+
+        for name, path, klass in serializers:
+            try:
+                yield name, (path, klass())
+            except ImproperlyConfigured as e:
+                # Missing optional dependency
+                self.stderr.write('Skipping {}: {}'.format(name, e))
+
+    def benchmark(self, name, serializer, payloads, repeat):
+        """ Measure `serializer` over the payloads it can serialize
+
+        :return: report entry
+        """
+        path, serializer = serializer
+
+        encoded = []
+        errors = 0
+        for payload in payloads:
+            try:
+                encoded.append((payload, serializer.dumps(payload)))
+            except Exception:
+                errors += 1
+
+        start = time.time()
+        for i in range(repeat):
+            for payload, _ in encoded:
+                serializer.dumps(payload)
+        dumps_seconds = time.time() - start
+
+        start = time.time()
+        for i in range(repeat):
+            for _, value in encoded:
+                serializer.loads(value)
+        loads_seconds = time.time() - start
+
+        # Separate pass, as tracing allocations slows down the timed loops
+        peak_memory = None
+        if tracemalloc is not None:
+            tracemalloc.start()
+            for payload, value in encoded:
+                serializer.dumps(payload)
+                serializer.loads(value)
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        operations = len(encoded) * repeat
+        size = sum(len(value) for _, value in encoded)
+        return {
+            'name': name,
+            'path': path,
+            'payloads': len(encoded),
+            'errors': errors,
+            'dumps_per_second': operations / dumps_seconds if dumps_seconds else None,
+            'loads_per_second': operations / loads_seconds if loads_seconds else None,
+            'dumps_bytes_per_second': size * repeat / dumps_seconds if dumps_seconds else None,
+            'size_bytes': size,
+            # As stored in `data_pickled`
+            'base64_size_bytes': sum(len(b64encode(value)) for _, value in encoded),
+            # As stored in `data_binary`, with the configured compression
+            'binary_size_bytes': sum(self.binary_size(value) for _, value in encoded),
+            'peak_memory_bytes': peak_memory,
+        }
+
+    def binary_size(self, value):
+        threshold = getattr(settings, 'TRANSMISSIONS_DATA_COMPRESS_THRESHOLD', 1024)
+        if threshold is not None and len(value) >= threshold:
+            return 1 + min(len(value), len(zlib.compress(value)))
+        return 1 + len(value)
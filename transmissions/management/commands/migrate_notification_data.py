@@ -0,0 +1,67 @@
+import logging
+import time
+from base64 import b64encode
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from transmissions.models import Notification
+from transmissions.serializer import pack, serializer
+
+
+class Command(BaseCommand):
+    help = 'Convert the data of existing notifications between the pickled and binary storages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--to', action='store', dest='to', choices=['binary', 'pickled'], default=None,
+                            help='Storage to convert to. Default: TRANSMISSIONS_DATA_STORAGE')
+        parser.add_argument('--batch-size', action='store', dest='batch_size', type=int, default=500,
+                            help='Number of notifications converted per transaction')
+        parser.add_argument('--sleep', action='store', dest='sleep', type=float, default=0,
+                            help='Seconds to wait between batches, to limit the load on the database')
+
+    def handle(self, to=None, batch_size=500, sleep=0, *args, **options):
+
+        if to is None:
+            to = getattr(settings, 'TRANSMISSIONS_DATA_STORAGE', 'pickled')
+        if to not in ('binary', 'pickled'):
+            raise CommandError('Unknown storage "{}"'.format(to))
+
+        if to == 'binary':
+            source = 'data_pickled'
+            notifications = Notification.objects.exclude(data_pickled='')
+        else:
+            source = 'data_binary'
+            notifications = Notification.objects.filter(data_binary__isnull=False)
+        notifications = notifications.order_by('id').only('id', 'data_pickled', 'data_binary')
+
+        converted = failed = 0
+        last_id = 0
+        while True:
+            batch = list(notifications.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+
+            with transaction.atomic():
+                for notification in batch:
+                    try:
+                        if to == 'binary':
+                            values = {'data_pickled': '', 'data_binary': pack(notification.data)}
+                        else:
+                            values = {'data_pickled': b64encode(serializer.dumps(notification.data)).decode(),
+                                      'data_binary': None}
+                    except Exception as e:
+                        logging.getLogger('django-transmissions').exception(e)
+                        failed += 1
+                        continue
+
+                    # Unless data was changed since it was read
+                    converted += Notification.objects.filter(
+                        pk=notification.pk, **{source: getattr(notification, source)}).update(**values)
+
+            last_id = batch[-1].id
+            self.stdout.write('{} notifications converted to {} storage'.format(converted, to))
+            if sleep:
+                time.sleep(sleep)
+
+        self.stdout.write('Done: {} notifications converted, {} could not be read'.format(converted, failed))
@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand
+from django.db import IntegrityError, transaction
+from transmissions.models import Notification, NotificationLedger, TriggerBehavior
+from transmissions.trigger import register
+from transmissions.utils import chunked
+
+
+class Command(BaseCommand):
+    help = 'Record notifications triggered before the ledger existed, for SEND_ONCE and TRIGGER_ONCE messages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', action='store', dest='batch_size', type=int, default=500,
+                            help='Number of ledger entries inserted at once')
+
+    def handle(self, batch_size=500, *args, **options):
+
+        for trigger_name, message_class in sorted(register.items()):
+            behavior = message_class.behavior
+            if behavior in (TriggerBehavior.SEND_ONCE, TriggerBehavior.SEND_ONCE_PER_CONTENT):
+                # Any notification ever triggered
+                notifications = Notification.objects.filter(trigger_name=trigger_name)
+            elif behavior in (TriggerBehavior.TRIGGER_ONCE, TriggerBehavior.TRIGGER_ONCE_PER_CONTENT):
+                # Only pending notifications
+                notifications = Notification.objects.filter(trigger_name=trigger_name).pending()
+            else:
+                continue
+
+            count = 0
+            rows = notifications.order_by('id').values_list('id', 'target_user_id', 'content_type_id', 'content_id')
+            for chunk in chunked(rows.iterator(), batch_size):
+                count += self.record(trigger_name, behavior, chunk)
+
+            self.stdout.write('{}: {} notifications recorded'.format(trigger_name, count))
+
+    def record(self, trigger_name, behavior, rows):
+
+        entries = {}
+        for notification_id, target_user_id, content_type_id, content_id in rows:
+            key = NotificationLedger.key(trigger_name, behavior, target_user_id, content_type_id, content_id)
+            entries.setdefault((key['target_user_id'], key['content_type_id'], key['content_id']),
+                               NotificationLedger(notification_id=notification_id, **key))
+
+        existing = NotificationLedger.objects.filter(trigger_name=trigger_name,
+                                                     target_user__in=set(key[0] for key in entries))
+        for key in existing.values_list('target_user_id', 'content_type_id', 'content_id'):
+            entries.pop(key, None)
+
+        try:
+            with transaction.atomic():
+                NotificationLedger.objects.bulk_create(list(entries.values()))
+            return len(entries)
+        except IntegrityError:
+            pass
+
+        # Entries were recorded concurrently, record one at a time
+        count = 0
+        for entry in entries.values():
+            try:
+                with transaction.atomic():
+                    entry.save()
+                count += 1
+            except IntegrityError:
+                pass
+        return count
@@ -1,27 +1,178 @@
-from optparse import make_option
+import time
+from collections import Counter
+from multiprocessing.pool import Pool, ThreadPool
+
+from django.db import connection, connections
 from django.utils import timezone
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from transmissions.models import Notification
-from transmissions.lock import lock
+from transmissions.tasks import dispatch_rows, process_notifications
+
+
+def retry(notification_ids, close_connection=False):
+    """ Process requeued notifications, in the command or in a pool worker
+
+    :return: statuses of the notifications
+    """
+    try:
+        process_notifications(notification_ids)
+        return list(Notification.objects.filter(pk__in=notification_ids).values_list('status', flat=True))
+    finally:
+        # Threads do not reuse their connection
+        if close_connection:
+            connection.close()
 
 
 class Command(BaseCommand):
     help = 'Retry to process failed notifications'
 
-    option_list = BaseCommand.option_list + (
-        make_option('--days', action='store', dest='days', type='int', default=7,
-            help='Number of days since last failure'),
-    )
+    def add_arguments(self, parser):
+        parser.add_argument('--days', action='store', dest='days', type=int, default=7,
+                            help='Number of days since last failure')
+        parser.add_argument('--trigger', action='append', dest='triggers', default=[],
+                            help='Only retry notifications of this trigger, can be repeated')
+        parser.add_argument('--limit', action='store', dest='limit', type=int, default=None,
+                            help='Maximum number of notifications to retry')
+        parser.add_argument('--rate', action='store', dest='rate', type=float, default=None,
+                            help='Maximum number of notifications retried per second')
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run', default=False,
+                            help='Only count the notifications that would be retried')
+        parser.add_argument('--mode', action='store', dest='mode', choices=['thread', 'process', 'celery'],
+                            default='thread',
+                            help='Retry in a pool of threads or processes of this command, or enqueue batch tasks '
+                                 'to Celery workers')
+        parser.add_argument('--workers', action='store', dest='workers', type=int, default=1,
+                            help='Size of the thread or process pool, 1 to retry in this process')
+        parser.add_argument('--batch-size', action='store', dest='batch_size', type=int, default=100,
+                            help='Number of notifications read and retried at once')
+
+    def handle(self, days=7, triggers=None, limit=None, rate=None, dry_run=False, mode='thread', workers=1,
+               batch_size=100, *args, **options):
+
+        if batch_size < 1 or workers < 1:
+            raise CommandError('--batch-size and --workers must be positive')
+        if rate is not None and rate <= 0:
+            raise CommandError('--rate must be positive')
+
+        now = timezone.now()
+        notifications = Notification.objects.filter(datetime_scheduled__lte=now,
+                                                    datetime_scheduled__gte=now - timezone.timedelta(days=days),
+                                                    status=Notification.Status.FAILED)
+        if triggers:
+            notifications = notifications.filter(trigger_name__in=triggers)
+
+        if dry_run:
+            counts = Counter(trigger_name for _, _, trigger_name in self.stream(notifications, batch_size, limit))
+            for trigger_name, count in sorted(counts.items()):
+                self.stdout.write('{}: {}'.format(trigger_name, count))
+            self.stdout.write('Dry run: {} notifications would be retried'.format(sum(counts.values())))
+            return
+
+        pool = None
+        if mode == 'thread' and workers > 1:
+            pool = ThreadPool(workers)
+        elif mode == 'process' and workers > 1:
+            # Forked workers open their own connections
+            connections.close_all()
+            pool = Pool(workers)
+
+        self.started = time.time()
+        self.requeued = 0
+        self.statuses = Counter()
+        pending = []
+        try:
+            for chunk in self.chunks(notifications, batch_size, limit):
+                if rate:
+                    # Wait until the chunk is within the rate
+                    delay = self.started + (self.requeued + len(chunk)) / rate - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+
+                rows = self.requeue(chunk)
+                if not rows:
+                    continue
+
+                if mode == 'celery':
+                    dispatch_rows(rows)
+                    self.progress('enqueued')
+                elif pool is None:
+                    self.record(retry([notification_id for _, notification_id, _ in rows]))
+                else:
+                    pending.append(pool.apply_async(retry, ([notification_id for _, notification_id, _ in rows],
+                                                            mode == 'thread')))
+                    # Bound the number of chunks waiting for a worker
+                    while len(pending) > workers * 2:
+                        self.record(pending.pop(0).get())
+
+            for result in pending:
+                self.record(result.get())
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        elapsed = time.time() - self.started
+        self.stdout.write('Done: {} notifications {} in {:.1f}s ({:.1f}/s){}'.format(
+            self.requeued, 'enqueued' if mode == 'celery' else 'retried', elapsed,
+            self.requeued / elapsed if elapsed else 0, self.summary()))
+
+    def stream(self, notifications, batch_size, limit=None):
+        """ Yield `(datetime_scheduled, id, trigger_name)` rows, reading `batch_size` rows per query """
+
+        rows = notifications.order_by('id').values_list('datetime_scheduled', 'id', 'trigger_name')
+        count = 0
+        last_id = 0
+        while limit is None or count < limit:
+            size = batch_size if limit is None else min(batch_size, limit - count)
+            read = 0
+            for row in rows.filter(id__gt=last_id)[:size].iterator():
+                read += 1
+                last_id = row[1]
+                yield row
+            count += read
+            if read < size:
+                break
+
+    def chunks(self, notifications, batch_size, limit=None):
+        chunk = []
+        for row in self.stream(notifications, batch_size, limit):
+            chunk.append(row)
+            if len(chunk) >= batch_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def requeue(self, rows):
+        """ Release failed notifications to be processed again, unless they were retried meanwhile
+
+        Attempts are kept, so that a notification failing again is marked as failed without being retried
+        automatically.
+
+        :return: rows requeued
+        """
 
-    def handle(self, days, db_dry_run=False, *args, **options):
+        notification_ids = [notification_id for _, notification_id, _ in rows]
+        Notification.objects.filter(pk__in=notification_ids, status=Notification.Status.FAILED)\
+            .update(status=Notification.Status.CREATED, datetime_processed=None, datetime_next_attempt=None,
+                    claimed_by='', datetime_lease_expires=None)
+        requeued = set(Notification.objects.filter(pk__in=notification_ids, status=Notification.Status.CREATED)
+                       .values_list('id', flat=True))
+        rows = [row for row in rows if row[1] in requeued]
+        self.requeued += len(rows)
+        return rows
 
-        since_datetime = timezone.now() - timezone.timedelta(days=days)
+    def record(self, statuses):
+        self.statuses.update(statuses)
+        self.progress('retried')
 
-        notifications = Notification.objects.filter(datetime_scheduled__lte=timezone.now(),
-                                                    datetime_scheduled__gte=since_datetime,
-                                                    status=Notification.Status.FAILED).order_by('datetime_scheduled')
+    def progress(self, action):
+        elapsed = time.time() - self.started
+        self.stdout.write('{} notifications {} ({:.1f}/s){}'.format(
+            self.requeued, action, self.requeued / elapsed if elapsed else 0, self.summary()))
 
-        for notification in notifications:
-            self.stdout.write("Sending {}".format(notification))
-            with lock('{0}'.format(notification.id)):
-                notification.send()
+    def summary(self):
+        if not self.statuses:
+            return ''
+        return ': {} sent, {} failed'.format(self.statuses[Notification.Status.SUCCESSFULLY_SENT],
+                                             self.statuses[Notification.Status.FAILED])
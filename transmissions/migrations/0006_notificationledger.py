@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 12:52
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('transmissions', '0005_notification_lease'),
+    ]
+
+    if hasattr(settings, 'TRANSMISSION_USER_MODEL'):
+        USER_MODEL = settings.TRANSMISSION_USER_MODEL
+    else:
+        USER_MODEL = settings.AUTH_USER_MODEL
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationLedger',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trigger_name', models.CharField(max_length=50)),
+                ('content_type_id', models.PositiveIntegerField(default=0)),
+                ('content_id', models.PositiveIntegerField(default=0)),
+                ('datetime_created', models.DateTimeField(auto_now_add=True)),
+                ('notification', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='transmissions.Notification')),
+                ('target_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='notificationledger',
+            unique_together=set([('target_user', 'trigger_name', 'content_type_id', 'content_id')]),
+        ),
+    ]
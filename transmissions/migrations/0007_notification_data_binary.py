@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 13:01
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transmissions', '0006_notificationledger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='data_binary',
+            field=models.BinaryField(null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 13:37
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transmissions', '0008_notification_attempts'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='notification',
+            index_together=set([('trigger_name', 'datetime_processed', 'datetime_scheduled'), ('target_user', 'datetime_scheduled'), ('target_user', 'trigger_name', 'datetime_processed'), ('datetime_processed', 'datetime_scheduled')]),
+        ),
+    ]
@@ -12,7 +12,12 @@
     Most commonly email or mobile push for iOS or Android.
 """
 
+import logging
+import math
+import random
+import time
 from base64 import b64decode, b64encode
+from collections import OrderedDict
 
 from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey
@@ -23,14 +28,26 @@ try:
 except ImportError:
     from django.core.urlresolvers import reverse
 
-from django.db import models
+from django.db import IntegrityError, connections, models, router, transaction
 from django.utils import timezone
 
+try:
+    from django.db.models import prefetch_related_objects
+except ImportError:
+    # Django < 1.10
+    from django.db.models.query import prefetch_related_objects as _prefetch_related_objects
+
+    def prefetch_related_objects(model_instances, *related_lookups):
+        _prefetch_related_objects(model_instances, related_lookups)
+
 from django_extensions.db import fields
+from transmissions.breaker import CircuitBreaker
 from transmissions.channels import Channel
 from transmissions.exceptions import ChannelSendException
-from transmissions.utils import EnumDict
-from transmissions.serializer import serializer
+from transmissions.ratelimit import get_interval, get_limits, throttle
+from transmissions.utils import EnumDict, worker_name
+from transmissions.serializer import pack, serializer, unpack
+from transmissions.trigger import register
 
 if hasattr(settings, 'TRANSMISSION_USER_MODEL'):
     USER_MODEL = settings.TRANSMISSION_USER_MODEL
@@ -50,6 +67,118 @@ class BaseModel(models.Model):
         return reverse(view_name_for_model(self), args=(self.id,))
 
 
+def skip_locked_supported(using=None):
+    """ Whether the database supports ``SELECT ... FOR UPDATE SKIP LOCKED`` to claim notifications
+    """
+    using = using or router.db_for_write(Notification)
+    return getattr(connections[using].features, 'has_select_for_update_skip_locked', False)
+
+
+def get_lease_duration():
+    """ How long a dispatched or claimed notification is reserved before being dispatched again
+    """
+    return timezone.timedelta(seconds=getattr(settings, 'TRANSMISSIONS_LEASE_SECONDS', 300))
+
+
+def get_max_attempts(trigger_name):
+    """ How many times a notification of the trigger is sent before it is marked as failed
+    """
+    default = getattr(settings, 'TRANSMISSIONS_MAX_ATTEMPTS', 3)
+    return getattr(register.get(trigger_name), 'kwargs', {}).get('max_attempts', default)
+
+
+def get_retry_delay(attempts):
+    """ How long to wait before sending a notification again after `attempts` failed sends
+
+    The delay doubles with each attempt up to `TRANSMISSIONS_RETRY_BACKOFF_MAX`, and is randomized by up to half so
+    that notifications failed together are not retried together. It is randomized in tenths and rounded up to the
+    second, so that the retries of a batch are recorded with a few UPDATEs.
+    """
+    base = getattr(settings, 'TRANSMISSIONS_RETRY_BACKOFF', 60)
+    delay = min(base * 2 ** max(attempts - 1, 0), getattr(settings, 'TRANSMISSIONS_RETRY_BACKOFF_MAX', 3600))
+    return timezone.timedelta(seconds=int(math.ceil(delay * (10 + random.randint(0, 10)) / 20.0)))
+
+
+class NotificationQuerySet(models.QuerySet):
+
+    def pending(self):
+        """ Notifications not processed yet """
+        return self.filter(datetime_processed__isnull=True)
+
+    def for_content(self, content):
+        """ Notifications about `content` """
+        return self.filter(content_type=ContentType.objects.get_for_model(content), content_id=content.pk)
+
+    def cancel(self):
+        """ Cancel pending notifications with a single UPDATE
+
+        :return: number of notifications cancelled
+        """
+        return self.pending().update(status=Notification.Status.CANCELLED, datetime_processed=timezone.now())
+
+    def due(self, now=None):
+        """ Pending notifications scheduled by `now`, not waiting to be retried, and not leased to a worker or
+        dispatched already
+        """
+        now = now or timezone.now()
+        return self.pending().filter(models.Q(datetime_lease_expires__isnull=True) |
+                                     models.Q(datetime_lease_expires__lt=now),
+                                     models.Q(datetime_next_attempt__isnull=True) |
+                                     models.Q(datetime_next_attempt__lte=now),
+                                     datetime_scheduled__lte=now)
+
+    def claimable(self, now=None):
+        """ Pending notifications scheduled by `now` and not waiting to be retried, which are not in-flight or whose
+        worker's lease has expired
+        """
+        now = now or timezone.now()
+        return self.pending().filter(models.Q(status=Notification.Status.CREATED) |
+                                     models.Q(status=Notification.Status.PROCESSING,
+                                              datetime_lease_expires__lt=now),
+                                     models.Q(datetime_next_attempt__isnull=True) |
+                                     models.Q(datetime_next_attempt__lte=now),
+                                     datetime_scheduled__lte=now)
+
+    def lease(self):
+        """ Reserve due notifications for the lease duration so that they are not dispatched again
+
+        Notifications whose worker's lease expired are released to be claimed again.
+        """
+        now = timezone.now()
+        return self.due(now).update(status=Notification.Status.CREATED,
+                                    claimed_by='',
+                                    datetime_lease_expires=now + get_lease_duration())
+
+    def claim(self, limit=None):
+        """ Claim notifications waiting to be processed and mark them in-flight
+
+        On databases supporting it, rows are selected with ``SELECT ... FOR UPDATE SKIP LOCKED`` and flipped to
+        `PROCESSING` in the same transaction, so concurrent workers never claim the same notification. Otherwise,
+        the caller must hold a lock on the notifications.
+
+        The claim is leased to this worker, and can be claimed again by another one once the lease expires.
+
+        :param limit: maximum number of notifications to claim
+        :return: list of claimed notifications
+        """
+        now = timezone.now()
+        with transaction.atomic(using=self.db):
+            queryset = self.claimable(now)
+            if skip_locked_supported(self.db):
+                queryset = queryset.select_for_update(skip_locked=True)
+            notification_ids = list(queryset.values_list('id', flat=True)[:limit])
+            if notification_ids:
+                self.model.objects.using(self.db).filter(pk__in=notification_ids)\
+                    .update(status=Notification.Status.PROCESSING,
+                            claimed_by=worker_name(),
+                            datetime_lease_expires=now + get_lease_duration())
+
+        if not notification_ids:
+            return []
+        return list(self.model.objects.using(self.db).filter(pk__in=notification_ids)
+                    .select_related('target_user', 'trigger_user').order_by('datetime_scheduled'))
+
+
 class Notification(BaseModel):
 
     """
@@ -64,6 +193,7 @@ class Notification(BaseModel):
     """
     class Status(EnumDict):
         CREATED = 0
+        PROCESSING = 2
         FAILED = -1
         CANCELLED = -2
         BROKEN = -3
@@ -81,6 +211,8 @@ class Notification(BaseModel):
     content_id = models.PositiveIntegerField(null=True, blank=True)
     content = GenericForeignKey('content_type', 'content_id')
     data_pickled = models.TextField(blank=True, editable=False)
+    # Data packed with `transmissions.serializer.pack()`, when `TRANSMISSIONS_DATA_STORAGE` is 'binary'
+    data_binary = models.BinaryField(null=True, editable=False)
 
     datetime_created = models.DateTimeField(null=True, auto_now_add=True)
     datetime_scheduled = models.DateTimeField(db_index=True)
@@ -90,65 +222,405 @@ class Notification(BaseModel):
 
     status = models.IntegerField(default=Status.CREATED)
 
+    # Worker processing the notification, and until when it is reserved
+    claimed_by = models.CharField(max_length=100, blank=True, default='', editable=False)
+    datetime_lease_expires = models.DateTimeField(null=True, editable=False)
+
+    # Number of times the notification was sent, and when it is sent again after a failure
+    attempts = models.PositiveIntegerField(default=0, editable=False)
+    datetime_next_attempt = models.DateTimeField(null=True, editable=False)
+
+    objects = NotificationQuerySet.as_manager()
+
+    DATA_FIELDS = ('data_pickled', 'data_binary')
+
     @property
     def data(self):
         if not hasattr(self, '_data'):
-            if len(self.data_pickled) <= 0:
-                self._data = {}
-            else:
-                self._data = serializer.loads(b64decode(self.data_pickled.encode()))
+            self._data = self.load_data()
         return self._data
 
     @data.setter
     def data(self, value):
         self._data = value
+        self._data_assigned = True
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Notification, cls).from_db(db, field_names, values)
+        instance._data_saved = instance.stored_data()
+        return instance
+
+    def load_data(self):
+        """ Deserialize the data fields """
+        if self.data_binary is not None:
+            return unpack(self.data_binary)
+        elif len(self.data_pickled) <= 0:
+            return {}
+        return serializer.loads(b64decode(self.data_pickled.encode()))
+
+    def stored_data(self):
+        """ Loaded values of the data fields """
+        return tuple(self.__dict__.get(field) for field in self.DATA_FIELDS)
+
+    def data_changed(self):
+        """ Whether `data` may differ from the data fields as last loaded or saved
+
+        Data that was loaded may have been mutated in place, data that was never accessed is left as is.
+        """
+        if self._state.adding or hasattr(self, '_data'):
+            return True
+        return self.stored_data() != getattr(self, '_data_saved', ('', None))
+
+    def data_modified(self):
+        """ Whether `data` was assigned, or accessed and mutated in place, since it was loaded or saved
+
+        Accessed data is compared with the data fields deserialized again, and considered modified if it can't be.
+        """
+        if getattr(self, '_data_assigned', False):
+            return True
+        if not hasattr(self, '_data'):
+            return False
+        try:
+            return self._data != self.load_data()
+        except Exception:
+            return True
+
+    def status_fields(self):
+        """ Fields written when the notification is processed """
+        fields = ['status', 'datetime_processed', 'attempts', 'datetime_next_attempt']
+        if self.status == self.Status.CREATED:
+            # Released to be retried
+            fields.extend(['claimed_by', 'datetime_lease_expires'])
+        if self.data_modified():
+            fields.extend(self.DATA_FIELDS)
+        return fields
 
     class Meta:
         index_together = [['datetime_processed', 'datetime_scheduled'],
                           ['target_user', 'datetime_scheduled'],
-                          ['target_user', 'trigger_name', 'datetime_processed']]
+                          ['target_user', 'trigger_name', 'datetime_processed'],
+                          ['trigger_name', 'datetime_processed', 'datetime_scheduled']]
         app_label = 'transmissions'
 
     def send(self):
         """ Process notification and send via designated channel
         """
 
+        deferred = False
         try:
             channel = Channel(self)
             # Notification is not needed anymore
             if not channel.check_validity():
                 self.status = self.Status.CANCELLED
             else:
-                channel.send()
+                breaker = CircuitBreaker.for_message(channel.message.__class__)
+                # Provider is down, or over the rate limit: send it later
+                wait = breaker.retry_after() if not breaker.allow() else throttle(channel.message.__class__)
+                if wait:
+                    deferred = True
+                    self.defer(timezone.now() + timezone.timedelta(seconds=wait))
+                    return
+                try:
+                    self.attempts += 1
+                    channel.send()
+                except ChannelSendException:
+                    try:
+                        self.defer_provider(breaker.provider, breaker.failure())
+                    except Exception as e:
+                        # Pending notifications are deferred when processed instead
+                        logging.getLogger('django-transmissions').exception(e)
+                    raise
+                breaker.success()
                 self.status = self.Status.SUCCESSFULLY_SENT
             if channel.message.behavior == TriggerBehavior.DELETE_AFTER_PROCESSING:
                 self.delete()
         except ChannelSendException:
-            self.status = self.Status.FAILED
+            self.failed()
         except:
             self.status = self.Status.BROKEN
             raise
         finally:
-            if self.pk:
-                self.datetime_processed = timezone.now()
-                self.save()
+            if self.pk and not deferred:
+                if self.status != self.Status.CREATED:
+                    self.datetime_processed = timezone.now()
+                    self.datetime_next_attempt = None
+                self.save(update_fields=self.status_fields())
+
+    @classmethod
+    def send_many(cls, notifications):
+        """ Process notifications in a batch and send them via their designated channel
+
+        Notifications of the same trigger are sent together with `Channel.send_many()`. Unlike `send()`, broken
+        notifications do not raise, so that they do not hold back the rest of the batch.
+        """
+
+        logger = logging.getLogger('django-transmissions')
+        cls.prefetch_many(notifications)
+
+        channels = OrderedDict()
+        try:
+            triggers = OrderedDict()
+            for notification in notifications:
+                try:
+                    channel = Channel(notification)
+                    channels[notification] = channel
+                    triggers.setdefault(notification.trigger_name, []).append(channel)
+                except Exception as e:
+                    logger.exception(e)
+                    notification.status = cls.Status.BROKEN
+
+            for trigger_channels in triggers.values():
+                message_class = trigger_channels[0].message.__class__
+                if hasattr(message_class, 'check_validity_many'):
+                    # Check all notifications of the trigger at once
+                    try:
+                        valid = message_class.check_validity_many([channel.notification
+                                                                   for channel in trigger_channels])
+                        valid_ids = set(notification.pk for notification in valid)
+                    except Exception as e:
+                        logger.exception(e)
+                        for channel in trigger_channels:
+                            channel.notification.status = cls.Status.BROKEN
+                        continue
+                    valid_channels = [channel for channel in trigger_channels if channel.notification.pk in valid_ids]
+                else:
+                    valid_channels = []
+                    for channel in trigger_channels:
+                        try:
+                            if channel.check_validity():
+                                valid_channels.append(channel)
+                        except Exception as e:
+                            logger.exception(e)
+                            channel.notification.status = cls.Status.BROKEN
+
+                valid_set = set(valid_channels)
+                for channel in trigger_channels:
+                    # Notification is not needed anymore
+                    if channel not in valid_set and channel.notification.status != cls.Status.BROKEN:
+                        channel.notification.status = cls.Status.CANCELLED
+
+                if get_limits(message_class):
+                    valid_channels = cls.throttle_many(message_class, valid_channels)
+
+                breaker = CircuitBreaker.for_message(message_class)
+                while valid_channels:
+                    if not breaker.allow():
+                        # Provider is down
+                        datetime_scheduled = timezone.now() + timezone.timedelta(seconds=breaker.retry_after())
+                        for channel in valid_channels:
+                            channel.notification.status = cls.Status.CREATED
+                            channel.notification.datetime_scheduled = datetime_scheduled
+                        break
+
+                    # Send a single probe when the circuit is half-open, and stop soon after it opens
+                    size = 1 if breaker.probing else breaker.threshold or len(valid_channels)
+                    sent_channels, valid_channels = valid_channels[:size], valid_channels[size:]
+                    errors = Channel.send_many(sent_channels)
+                    now = timezone.now()
+                    for channel, error in zip(sent_channels, errors):
+                        channel.notification.attempts += 1
+                        if error:
+                            channel.notification.failed(now)
+                        else:
+                            channel.notification.status = cls.Status.SUCCESSFULLY_SENT
+                    try:
+                        cls.defer_provider(breaker.provider, breaker.record(errors))
+                    except Exception as e:
+                        # Pending notifications are deferred when processed instead
+                        logger.exception(e)
+        finally:
+            for notification in notifications:
+                # Not sent because of an error: released to be processed again
+                if notification.status == cls.Status.PROCESSING:
+                    notification.status = cls.Status.CREATED
+            cls.record_many(notifications, channels)
+
+    @classmethod
+    def defer_provider(cls, provider, opened_until):
+        """ Reschedule pending notifications of a provider when its circuit opened, until it half-opens
+
+        :param opened_until: timestamp until which the circuit is open, or None if it did not open
+        """
+        if opened_until is None:
+            return 0
+
+        trigger_names = [trigger_name for trigger_name, message_class in register.items()
+                         if CircuitBreaker.provider_of(message_class) == provider]
+        # Aware or naive, as `timezone.now()` with `USE_TZ`
+        datetime_scheduled = timezone.now() + timezone.timedelta(seconds=opened_until - time.time())
+        return cls.objects.pending().filter(status=cls.Status.CREATED, trigger_name__in=trigger_names,
+                                            datetime_scheduled__lt=datetime_scheduled)\
+            .update(datetime_scheduled=datetime_scheduled)
+
+    @classmethod
+    def prefetch_many(cls, notifications):
+        """ Prefetch objects used by messages for notifications of each trigger at once
+
+        Lookups are set with the `prefetch_related` kwarg of the `message` decorator. Default: `('content',)`,
+        for which contents are fetched with one query per content type.
+        """
+
+        triggers = OrderedDict()
+        for notification in notifications:
+            triggers.setdefault(notification.trigger_name, []).append(notification)
+
+        for trigger_name, trigger_notifications in triggers.items():
+            message_class = register.get(trigger_name)
+            lookups = getattr(message_class, 'kwargs', {}).get('prefetch_related', ('content',))
+            if not lookups:
+                continue
+            try:
+                prefetch_related_objects(trigger_notifications, *lookups)
+            except Exception as e:
+                # Objects are fetched by messages when used
+                logging.getLogger('django-transmissions').exception(e)
+
+    @classmethod
+    def throttle_many(cls, message_class, channels):
+        """ Take rate limit tokens for the channels of a trigger, and defer those over the limit
+
+        Deferred notifications are spread at the rate of the limit, rounded to the second.
+
+        :return: channels which can be sent
+        """
+
+        for i, channel in enumerate(channels):
+            wait = throttle(message_class)
+            if wait:
+                break
+        else:
+            return channels
+
+        now = timezone.now().replace(microsecond=0)
+        interval = get_interval(message_class)
+        for k, channel in enumerate(channels[i:]):
+            channel.notification.status = cls.Status.CREATED
+            channel.notification.datetime_scheduled = now + timezone.timedelta(
+                seconds=int(math.ceil(wait + k * interval)))
+        return channels[:i]
+
+    @classmethod
+    def record_many(cls, notifications, channels):
+        """ Record the outcome of processed notifications with one UPDATE per status
+
+        Notifications whose data was assigned or mutated are saved one at a time, and `DELETE_AFTER_PROCESSING`
+        notifications sent or cancelled are deleted at once. Notifications deferred by rate limits or circuit breakers
+        are rescheduled with one UPDATE per schedule, and notifications to be retried with one UPDATE per next
+        attempt.
+        """
+
+        now = timezone.now()
+        statuses = OrderedDict()
+        deferred = OrderedDict()
+        retried = OrderedDict()
+        deleted = []
+        for notification in notifications:
+            if notification.status == cls.Status.CREATED:
+                if getattr(notification, '_retried', False):
+                    key = (notification.datetime_next_attempt, notification.attempts)
+                    retried.setdefault(key, []).append(notification.pk)
+                else:
+                    deferred.setdefault(notification.datetime_scheduled, []).append(notification.pk)
+                continue
+
+            channel = channels.get(notification)
+            if (channel is not None and channel.message.behavior == TriggerBehavior.DELETE_AFTER_PROCESSING and
+                    notification.status in (cls.Status.SUCCESSFULLY_SENT, cls.Status.CANCELLED)):
+                deleted.append(notification)
+                continue
+
+            notification.datetime_processed = now
+            fields = notification.status_fields()
+            if 'data_pickled' in fields:
+                notification.save(update_fields=fields)
+            else:
+                statuses.setdefault((notification.status, notification.attempts), []).append(notification.pk)
+
+        for (status, attempts), notification_ids in statuses.items():
+            cls.objects.filter(pk__in=notification_ids).update(status=status, datetime_processed=now,
+                                                               attempts=attempts, datetime_next_attempt=None)
+
+        for datetime_scheduled, notification_ids in deferred.items():
+            cls.objects.filter(pk__in=notification_ids).update(status=cls.Status.CREATED,
+                                                               datetime_scheduled=datetime_scheduled,
+                                                               claimed_by='',
+                                                               datetime_lease_expires=None)
+
+        for (datetime_next_attempt, attempts), notification_ids in retried.items():
+            cls.objects.filter(pk__in=notification_ids).update(status=cls.Status.CREATED,
+                                                               datetime_next_attempt=datetime_next_attempt,
+                                                               attempts=attempts,
+                                                               claimed_by='',
+                                                               datetime_lease_expires=None)
+
+        if deleted:
+            cls.objects.filter(pk__in=[notification.pk for notification in deleted]).delete()
+            for notification in deleted:
+                notification.pk = None
+
+    def failed(self, now=None):
+        """ Record a failed send: release the notification to be retried after a backoff, or mark it as failed once
+        it was sent the maximum number of attempts of its trigger
+        """
+        self._retried = self.attempts < get_max_attempts(self.trigger_name)
+        if not self._retried:
+            self.status = self.Status.FAILED
+            self.datetime_next_attempt = None
+            return
+
+        self.status = self.Status.CREATED
+        self.datetime_next_attempt = (now or timezone.now()).replace(microsecond=0) + get_retry_delay(self.attempts)
+        self.claimed_by = ''
+        self.datetime_lease_expires = None
+
+    def defer(self, datetime_scheduled):
+        """ Release the notification to be processed again at `datetime_scheduled` """
+        self.status = self.Status.CREATED
+        self.datetime_scheduled = datetime_scheduled
+        self.claimed_by = ''
+        self.datetime_lease_expires = None
+        self.save(update_fields=['status', 'datetime_scheduled', 'claimed_by', 'datetime_lease_expires'])
 
     def cancel(self):
         self.datetime_processed = timezone.now()
         self.status = self.Status.CANCELLED
-        self.save()
+        self.save(update_fields=self.status_fields())
 
-    def save(self, *args, **kwargs):
+    def serialize_data(self):
         """
-        Store pickled data before saving
+        Store pickled data, or packed data with the binary storage, marking the notification as broken if data
+        can't be serialized
         """
 
+        if getattr(settings, 'TRANSMISSIONS_DATA_STORAGE', 'pickled') == 'binary':
+            self.data_pickled = ''
+            try:
+                self.data_binary = pack(self.data)
+            except:
+                self.data_binary = pack('{}')
+                self.status = self.Status.BROKEN
+            return
+
+        self.data_binary = None
         try:
             self.data_pickled = b64encode(serializer.dumps(self.data)).decode()
         except:
             self.data_pickled = b64encode(serializer.dumps('{}')).decode()
             self.status = self.Status.BROKEN
+
+    def save(self, *args, **kwargs):
+        """
+        Store pickled data before saving, if it is saved and may have changed
+        """
+
+        update_fields = kwargs.get('update_fields')
+        if ((update_fields is None or set(self.DATA_FIELDS).intersection(update_fields)) and
+                self.data_changed()):
+            self.serialize_data()
         super(Notification, self).save(*args, **kwargs)
+        self._data_saved = self.stored_data()
+        self._data_assigned = False
 
     def __unicode__(self):
         return u'Notification #{} to user #{}: {}'.format(
@@ -174,3 +646,80 @@ class TriggerBehavior(EnumDict):
     SEND_ONCE_PER_CONTENT = 35
     # Cancel all pending notifications when a new one is scheduled.
     LAST_ONLY = 40
+
+
+class NotificationLedger(models.Model):
+    """
+    Record of the notifications triggered for a message with a `SEND_ONCE*` or `TRIGGER_ONCE*` behavior
+
+    Entries are unique per user, trigger and content so that recording a notification is the duplicate check,
+    whatever the size of the `Notification` table. Entries outlive notifications, which can be purged.
+
+    For `TRIGGER_ONCE*` behaviors, an entry whose notification was processed (or deleted) is stale and can be
+    taken over by a new notification.
+    """
+
+    trigger_name = models.CharField(max_length=50)
+    target_user = models.ForeignKey(USER_MODEL, related_name='+', on_delete=models.CASCADE)
+
+    # 0 when the behavior is not per content, so that the unique constraint applies without NULLs
+    content_type_id = models.PositiveIntegerField(default=0)
+    content_id = models.PositiveIntegerField(default=0)
+
+    notification = models.ForeignKey(Notification, related_name='+', null=True, on_delete=models.SET_NULL)
+
+    datetime_created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = [['target_user', 'trigger_name', 'content_type_id', 'content_id']]
+        app_label = 'transmissions'
+
+    @staticmethod
+    def key(trigger_name, behavior, target_user_id, content_type_id=None, content_id=None):
+        """ Lookup for the ledger entry of a notification """
+        key = {'trigger_name': trigger_name, 'target_user_id': target_user_id,
+               'content_type_id': 0, 'content_id': 0}
+        if behavior in (TriggerBehavior.SEND_ONCE_PER_CONTENT, TriggerBehavior.TRIGGER_ONCE_PER_CONTENT):
+            key.update(content_type_id=content_type_id or 0, content_id=content_id or 0)
+        return key
+
+    @staticmethod
+    def stale():
+        """ Entries which can be taken over with a `TRIGGER_ONCE*` behavior """
+        return models.Q(notification__isnull=True) | models.Q(notification__datetime_processed__isnull=False)
+
+    @classmethod
+    def record(cls, notification, behavior):
+        """ Record a new notification in the ledger
+
+        :return: False if the notification is a duplicate according to `behavior`
+        """
+
+        key = cls.key(notification.trigger_name, behavior, notification.target_user_id,
+                      notification.content_type_id, notification.content_id)
+        try:
+            with transaction.atomic():
+                cls.objects.create(notification=notification, **key)
+            return True
+        except IntegrityError:
+            if behavior not in (TriggerBehavior.TRIGGER_ONCE, TriggerBehavior.TRIGGER_ONCE_PER_CONTENT):
+                return False
+
+        entry = cls.objects.filter(**key).values_list('pk', 'notification_id').first()
+        if entry is None:
+            # Stale entry deleted by `trigger_many()` meanwhile
+            try:
+                with transaction.atomic():
+                    cls.objects.create(notification=notification, **key)
+                return True
+            except IntegrityError:
+                return False
+
+        # Take over the entry if its notification is not pending anymore
+        entry_id, notification_id = entry
+        if (notification_id is not None and
+                Notification.objects.filter(pk=notification_id, datetime_processed__isnull=True).exists()):
+            return False
+
+        # Compare and swap, so that a single trigger takes over an entry, even when both read it as stale
+        return cls.objects.filter(pk=entry_id, notification_id=notification_id).update(notification=notification) > 0
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+    django-transmissions.ratelimit
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Outbound rate limits per channel type and per trigger, with token buckets shared by workers.
+
+    Buckets are implemented with the generic cell rate algorithm: a bucket only stores the theoretical arrival time
+    of the next send, which the cache can update atomically with `incr`.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_rate(rate):
+    """ Parse a rate such as '10/s', '600/m' or '10000/h'
+
+    :return: `(count, period)`, period in seconds
+    """
+    try:
+        count, period = rate.split('/')
+        return int(count), PERIODS[period]
+    except (AttributeError, KeyError, ValueError):
+        raise ImproperlyConfigured('Invalid rate "{}"'.format(rate))
+
+
+class BaseRateLimitBackend(object):
+
+    def acquire(self, key, count, period):
+        """ Take a token from the bucket, which holds up to `count` tokens and is refilled at `count` per `period`
+
+        :return: 0 if a token was taken, otherwise seconds until the next token is available
+        """
+        raise NotImplementedError()
+
+    def refund(self, key, count, period):
+        """ Put back a token taken with `acquire()` """
+        raise NotImplementedError()
+
+
+class LocalRateLimitBackend(BaseRateLimitBackend):
+    """ Buckets of this process only """
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.buckets = {}
+
+    def acquire(self, key, count, period):
+        interval = float(period) / count
+        now = time.time()
+        with self.mutex:
+            arrival = max(self.buckets.get(key, now), now) + interval
+            if arrival - now > period:
+                return arrival - now - period
+            self.buckets[key] = arrival
+            return 0
+
+    def refund(self, key, count, period):
+        with self.mutex:
+            if key in self.buckets:
+                self.buckets[key] -= float(period) / count
+
+
+class CacheRateLimitBackend(BaseRateLimitBackend):
+    """ Buckets in the Django cache, shared by workers
+
+    Falls back to buckets of this process when the cache is unavailable.
+    """
+
+    def __init__(self):
+        self.fallback = LocalRateLimitBackend()
+
+    def acquire(self, key, count, period):
+        try:
+            return self._acquire('transmissions-ratelimit-{}'.format(key), count, period)
+        except Exception as e:
+            logging.getLogger('django-transmissions').warning('Rate limit cache unavailable: %r', e)
+            return self.fallback.acquire(key, count, period)
+
+    def _acquire(self, cache_key, count, period):
+        # Microseconds, so that the cache can increment them
+        interval = int(period * 1000000 // count)
+        now = int(time.time() * 1000000)
+
+        # Buckets do not expire, as `incr` does not refresh the timeout: a bucket whose arrival time is past is full
+        try:
+            arrival = cache.incr(cache_key, interval)
+        except ValueError:
+            if cache.add(cache_key, now + interval, None):
+                return 0
+            arrival = cache.incr(cache_key, interval)
+
+        if arrival - interval < now:
+            # Bucket was full
+            cache.set(cache_key, now + interval, None)
+            return 0
+        if arrival - now > period * 1000000:
+            cache.decr(cache_key, interval)
+            return (arrival - now) / 1000000.0 - period
+        return 0
+
+    def refund(self, key, count, period):
+        try:
+            cache.decr('transmissions-ratelimit-{}'.format(key), int(period * 1000000 // count))
+        except ValueError:
+            # Bucket is full
+            pass
+        except Exception:
+            self.fallback.refund(key, count, period)
+
+
+_backends = {}
+
+
+def get_backend():
+    path = getattr(settings, 'TRANSMISSIONS_RATE_LIMIT_BACKEND', 'transmissions.ratelimit.CacheRateLimitBackend')
+    if path not in _backends:
+        _backends[path] = import_string(path)()
+    return _backends[path]
+
+
+def get_limits(message_class):
+    """ Rate limits of a message class
+
+    Limits of the channel type of the message (its `channel_type` attribute) are set with the
+    `TRANSMISSIONS_RATE_LIMITS` setting, keyed by `Channel.Types` value or name. Limits of a trigger are set
+    with the `rate_limit` kwarg of its message.
+
+    :return: list of `(key, count, period)`
+    """
+    from transmissions.channels import Channel
+
+    limits = []
+    channel_type = getattr(message_class, 'channel_type', None)
+    if channel_type is not None:
+        rates = getattr(settings, 'TRANSMISSIONS_RATE_LIMITS', {})
+        names = dict((value, name) for name, value in vars(Channel.Types).items() if name.isupper())
+        rate = rates.get(channel_type, rates.get(names.get(channel_type)))
+        if rate:
+            limits.append(('channel-{}'.format(channel_type),) + parse_rate(rate))
+
+    rate = getattr(message_class, 'kwargs', {}).get('rate_limit')
+    if rate:
+        limits.append(('trigger-{}'.format(message_class.trigger_name),) + parse_rate(rate))
+    return limits
+
+
+def throttle(message_class):
+    """ Take a token from each bucket of the message class before sending one message
+
+    :return: 0 if the message can be sent, otherwise seconds after which it should be sent
+    """
+    backend = get_backend()
+    acquired = []
+    for key, count, period in get_limits(message_class):
+        wait = backend.acquire(key, count, period)
+        if wait:
+            # Only send when all buckets have a token
+            for limit in acquired:
+                backend.refund(*limit)
+            return wait
+        acquired.append((key, count, period))
+    return 0
+
+
+def get_interval(message_class):
+    """ Seconds between two messages at the lowest rate limit of the message class, 0 if it is not limited """
+    return max([float(period) / count for _, count, period in get_limits(message_class)] or [0])
@@ -1,4 +1,6 @@
+import json
 import pickle
+import zlib
 from importlib import import_module
 from django.core.exceptions import ImproperlyConfigured
 from django.conf import settings
@@ -11,6 +13,33 @@ class DefaultSerializer(object):
         return pickle.loads(value)
 
 
+class JSONSerializer(object):
+    """ Compact JSON, for data made of dicts, lists, strings, numbers, booleans and None """
+
+    def dumps(self, value):
+        return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, value):
+        return json.loads(value.decode('utf-8'))
+
+
+class MsgpackSerializer(object):
+    """ MessagePack, a compact binary equivalent of JSON. Requires the `msgpack` package """
+
+    def __init__(self):
+        try:
+            import msgpack
+        except ImportError:
+            raise ImproperlyConfigured('MsgpackSerializer requires the msgpack package')
+        self.msgpack = msgpack
+
+    def dumps(self, value):
+        return self.msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, value):
+        return self.msgpack.unpackb(value, raw=False)
+
+
 def load_class(path):
     """
     Loads class from path.
@@ -45,3 +74,62 @@ def load_serializer(settings):
         return DefaultSerializer()
 
 serializer = load_serializer(settings)
+
+
+# Formats of binary data, identified by the first byte of the payload
+FORMATS = {
+    'serializer': 1,
+    'json': 2,
+    'msgpack': 3,
+}
+COMPRESSED = 0x80
+
+
+def get_format_serializer(code):
+    if code == FORMATS['serializer']:
+        return serializer
+    if code == FORMATS['json']:
+        return JSONSerializer()
+    if code == FORMATS['msgpack']:
+        return MsgpackSerializer()
+    raise ValueError('Unknown data format {}'.format(code))
+
+
+def pack(value, format=None, compress_threshold=None):
+    """ Serialize `value` to a self-describing payload for binary storage
+
+    The first byte identifies the format, with the high bit set if the rest is zlib compressed.
+
+    :param format: 'serializer' (the configured serializer), 'json' or 'msgpack'.
+                   Default: `TRANSMISSIONS_DATA_FORMAT` setting
+    :param compress_threshold: size from which payloads are compressed.
+                               Default: `TRANSMISSIONS_DATA_COMPRESS_THRESHOLD` setting
+    """
+
+    if format is None:
+        format = getattr(settings, 'TRANSMISSIONS_DATA_FORMAT', 'serializer')
+    if compress_threshold is None:
+        compress_threshold = getattr(settings, 'TRANSMISSIONS_DATA_COMPRESS_THRESHOLD', 1024)
+    if format not in FORMATS:
+        raise ImproperlyConfigured('Unknown data format "{0}"'.format(format))
+
+    code = FORMATS[format]
+    payload = get_format_serializer(code).dumps(value)
+    if compress_threshold is not None and len(payload) >= compress_threshold:
+        compressed = zlib.compress(payload)
+        # Keep incompressible payloads as they are
+        if len(compressed) < len(payload):
+            code, payload = code | COMPRESSED, compressed
+
+    return bytes(bytearray([code])) + payload
+
+
+def unpack(payload):
+    """ Deserialize a payload created by `pack()` """
+
+    payload = bytes(payload)
+    code = bytearray(payload[:1])[0]
+    payload = payload[1:]
+    if code & COMPRESSED:
+        payload = zlib.decompress(payload)
+    return get_format_serializer(code & ~COMPRESSED).loads(payload)
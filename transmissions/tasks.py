@@ -5,31 +5,171 @@
 
     Tasks to run asynchronously via Celery
 """
+from collections import OrderedDict
 
-from transmissions.lock import lock
-from django.utils import timezone
+from transmissions.dispatch import (Budget, get_cursor, get_cursor_key, get_queue, interleave, prioritize, scan,
+                                    set_cursor)
+from transmissions.exceptions import LockTimeout
+from transmissions.lock import acquire_lock, release_lock
+from transmissions.utils import chunked
+from django.conf import settings
+from celery.signals import worker_process_init, worker_process_shutdown
 from celery.task import task
 
+
+@worker_process_init.connect
+def setup_channels(**kwargs):
+    """ Set up provider clients of message classes once per worker process """
+    from transmissions.channels import Channel
+    Channel.setup()
+
+
+@worker_process_shutdown.connect
+def teardown_channels(**kwargs):
+    from transmissions.channels import Channel
+    Channel.teardown()
+
 @task(ignore_result=True)
-def process_notification(notification_id):
-    from transmissions.models import Notification
-    with lock('{0}'.format(notification_id)):
-        # Load notification
-        notification = Notification.objects.get(pk=notification_id)
+def process_notification(notification_id, requeued=0):
+    from transmissions.models import Notification, skip_locked_supported
+
+    # Claim the row in the database, no need for a lock
+    if skip_locked_supported():
+        for notification in Notification.objects.filter(pk=notification_id).claim():
+            notification.send()
+        return
+
+    # Do not wait for the lock, the worker moves on to the next task
+    try:
+        handle = acquire_lock('{0}'.format(notification_id), timeout=0)
+    except LockTimeout:
+        countdown = getattr(settings, 'TRANSMISSIONS_LOCK_REQUEUE_COUNTDOWN', 5)
+        if countdown is not None and requeued < getattr(settings, 'TRANSMISSIONS_LOCK_MAX_REQUEUES', 3):
+            # Stay on the queue of the trigger
+            queue = get_queue(Notification.objects.filter(pk=notification_id)
+                              .values_list('trigger_name', flat=True).first())
+            options = {'queue': queue} if queue else {}
+            process_notification.apply_async((notification_id,), {'requeued': requeued + 1}, countdown=countdown,
+                                             **options)
+        return
 
-        # Process if not processed already
-        if notification.status == Notification.Status.CREATED:
+    try:
+        # Process if not processed or claimed already
+        for notification in Notification.objects.filter(pk=notification_id).claim():
             notification.send()
+    finally:
+        release_lock(handle)
+
+
+@task(ignore_result=True)
+def process_notifications(notification_ids):
+    """ Process a chunk of notifications in a single worker invocation
+
+    Notifications claimed or locked by another worker are skipped, as they are already being processed.
+    """
+    from transmissions.models import Notification, skip_locked_supported
+
+    if skip_locked_supported():
+        Notification.send_many(Notification.objects.filter(pk__in=notification_ids).claim())
+        return
+
+    locks = {}
+    try:
+        for notification_id in notification_ids:
+            try:
+                locks[notification_id] = acquire_lock('{0}'.format(notification_id), timeout=0)
+            except LockTimeout:
+                continue
+
+        # Claim all notifications not processed already at once
+        Notification.send_many(Notification.objects.filter(pk__in=list(locks.keys())).claim())
+    finally:
+        for handle in locks.values():
+            release_lock(handle)
+
+
+def dispatch(notification_ids, queue=None):
+    """ Enqueue notifications to be processed
+
+    :param queue: Celery queue to route the tasks to, instead of the default queue
+    """
+    from transmissions.models import Notification
+
+    # Lease dispatched notifications so that they are not dispatched again while waiting in the broker
+    Notification.objects.filter(pk__in=notification_ids).lease()
+
+    batch_size = getattr(settings, 'TRANSMISSIONS_BATCH_SIZE', None)
+    if batch_size:
+        for chunk in chunked(notification_ids, batch_size):
+            if queue:
+                process_notifications.apply_async((chunk,), queue=queue)
+            else:
+                process_notifications.delay(chunk)
+    else:
+        for notification_id in notification_ids:
+            if queue:
+                process_notification.apply_async((notification_id,), queue=queue)
+            else:
+                process_notification.delay(notification_id)
+
+
+def dispatch_rows(rows):
+    """ Dispatch `(datetime_scheduled, id, trigger_name)` rows to the queues of their triggers """
+
+    queues = OrderedDict()
+    for _, notification_id, trigger_name in rows:
+        queues.setdefault(get_queue(trigger_name), []).append(notification_id)
+    for queue, notification_ids in queues.items():
+        dispatch(notification_ids, queue=queue)
 
 
 @task(ignore_result=True, time_limit=55)
 def process_all_notifications():
+    """ Dispatch due notifications to be processed
+
+    Due notifications of higher priority triggers are dispatched first. Within a priority, they are streamed in
+    `(datetime_scheduled, id)` order within a budget of rows and time per run. When the budget runs out, the next
+    run resumes where this one stopped.
+
+    In fair share mode, triggers of the same priority take turns instead, see `transmissions.dispatch.interleave`.
+    """
     from transmissions.models import Notification
-    notification_ids = Notification.objects.filter(datetime_scheduled__lte=timezone.now(),
-                                                   datetime_processed__isnull=True).order_by('datetime_scheduled')\
-        .values_list('id', flat=True)
 
-    for notification_id in notification_ids:
-        process_notification.delay(notification_id)
+    budget = Budget.from_settings()
+    chunk_size = getattr(settings, 'TRANSMISSIONS_DISPATCH_CHUNK_SIZE', 500)
+    fair_share = getattr(settings, 'TRANSMISSIONS_DISPATCH_FAIR_SHARE', False)
+
+    count = 0
+    for priority, queryset in prioritize(Notification.objects.due()):
+        if fair_share:
+            # Dispatched notifications are leased, no cursor is needed to resume
+            for rows in interleave(queryset, getattr(settings, 'TRANSMISSIONS_DISPATCH_FAIR_SHARE_SLICE', 100)):
+                rows = budget.limit(rows)
+                if rows:
+                    dispatch_rows(rows)
+                    count += len(rows)
+                    budget.spend(len(rows))
+                if budget.exhausted:
+                    return count
+            continue
+
+        cursor_key = get_cursor_key(priority)
+        for chunk in scan(queryset, get_cursor(cursor_key), chunk_size, fields=('trigger_name',)):
+            rows = budget.limit(chunk)
+            if rows:
+                dispatch_rows(rows)
+                count += len(rows)
+                budget.spend(len(rows))
+
+            # Last chunk was dispatched entirely
+            if len(rows) == len(chunk) < chunk_size:
+                break
+
+            if budget.exhausted:
+                if rows:
+                    set_cursor(rows[-1][:2], cursor_key)
+                return count
 
-    return len(notification_ids)
+        # Start over from the oldest due notification next time
+        set_cursor(None, cursor_key)
+    return count
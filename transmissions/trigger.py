@@ -1,17 +1,33 @@
 import logging
 
+from django.conf import settings
+from django.db import IntegrityError, transaction
 from django.utils import timezone
+from django.utils.module_loading import autodiscover_modules, import_string
 
-from transmissions.exceptions import DuplicateNotification
+from transmissions.exceptions import DuplicateNotification, DuplicateTriggerException
 from transmissions.lock import lock
+from transmissions.utils import chunked
 
+# Message classes by trigger name
 register = {}
 
 
+def autodiscover():
+    """ Register the messages defined in the `notifications` module of installed apps,
+    and those listed in the `TRANSMISSIONS_TRIGGERS` setting
+    """
+    autodiscover_modules('notifications')
+    for path in getattr(settings, 'TRANSMISSIONS_TRIGGERS', {}).values():
+        import_string(path)
+
+
 def message(trigger_name, behavior=None, **kwargs):
     def wrapper(cls):
-        from django.contrib.contenttypes.models import ContentType
-        from transmissions.models import TriggerBehavior, Notification
+        from transmissions.models import TriggerBehavior, Notification, NotificationLedger
+
+        ONCE_BEHAVIORS = (TriggerBehavior.SEND_ONCE, TriggerBehavior.SEND_ONCE_PER_CONTENT,
+                          TriggerBehavior.TRIGGER_ONCE, TriggerBehavior.TRIGGER_ONCE_PER_CONTENT)
 
         cls.trigger_name = trigger_name
         if behavior in TriggerBehavior.values.keys():
@@ -20,13 +36,15 @@ def message(trigger_name, behavior=None, **kwargs):
             cls.behavior = TriggerBehavior.DEFAULT
         cls.kwargs = kwargs
 
+        path = '{}.{}'.format(cls.__module__, cls.__name__)
         if trigger_name in register:
-            logging.getLogger('django-transmissions').warning(
-                'Duplicate definition for trigger {} at {} and {}.{}',
-                trigger_name, register[trigger_name],
-                cls.__module__, cls.__name__)
+            registered = register[trigger_name]
+            # Unless the module is imported again
+            if '{}.{}'.format(registered.__module__, registered.__name__) != path:
+                raise DuplicateTriggerException('Duplicate definition for trigger {} at {}.{} and {}'.format(
+                    trigger_name, registered.__module__, registered.__name__, path))
 
-        register[trigger_name] = "{}.{}".format(cls.__module__, cls.__name__)
+        register[trigger_name] = cls
 
         def trigger(cls, target_user, trigger_user=None,
                     datetime_scheduled=None, content=None, data=None, silent=True):
@@ -36,76 +54,50 @@ def message(trigger_name, behavior=None, **kwargs):
 
             # No need for a lock
             if cls.behavior in (TriggerBehavior.DEFAULT, TriggerBehavior.DELETE_AFTER_PROCESSING):
-                return _trigger_within_lock(cls,
-                                            target_user,
-                                            trigger_user,
-                                            datetime_scheduled,
-                                            content,
-                                            data,
-                                            silent)
+                notification = _trigger_within_lock(cls,
+                                                    target_user,
+                                                    trigger_user,
+                                                    datetime_scheduled,
+                                                    content,
+                                                    data)
+
+            # Duplicates are checked by the ledger's unique constraint
+            elif cls.behavior in ONCE_BEHAVIORS:
+                try:
+                    with transaction.atomic():
+                        notification = _trigger_within_lock(cls,
+                                                            target_user,
+                                                            trigger_user,
+                                                            datetime_scheduled,
+                                                            content,
+                                                            data)
+                        if not NotificationLedger.record(notification, cls.behavior):
+                            raise DuplicateNotification()
+                except DuplicateNotification:
+                    if not silent:
+                        raise
+                    return None
 
             # Acquire lock before triggering
             else:
                 key = '{}@{}'.format(cls.trigger_name, target_user.id)
-                if cls.behavior in (TriggerBehavior.SEND_ONCE_PER_CONTENT,
-                                    TriggerBehavior.TRIGGER_ONCE_PER_CONTENT):
-                    key += '+{}.{}'.format(content.__class__.__name__, content.id)
 
                 with lock(key):
-                    return _trigger_within_lock(cls,
-                                                target_user,
-                                                trigger_user,
-                                                datetime_scheduled,
-                                                content,
-                                                data,
-                                                silent)
+                    notification = _trigger_within_lock(cls,
+                                                        target_user,
+                                                        trigger_user,
+                                                        datetime_scheduled,
+                                                        content,
+                                                        data)
+
+            _dispatch_on_commit(cls, [notification])
+            return notification
 
         def _trigger_within_lock(cls, target_user, trigger_user=None,
-                                 datetime_scheduled=None, content=None, data=None, silent=True):
+                                 datetime_scheduled=None, content=None, data=None):
 
-            try:
-                if (cls.behavior == TriggerBehavior.SEND_ONCE and
-                        Notification.objects.filter(
-                            target_user=target_user,
-                            trigger_name=cls.trigger_name).exists()):
-                    raise DuplicateNotification()
-
-                if (cls.behavior == TriggerBehavior.SEND_ONCE_PER_CONTENT and
-                        Notification.objects.filter(
-                            target_user=target_user,
-                            trigger_name=cls.trigger_name,
-                            content_type=ContentType.objects.get_for_model(content),
-                            content_id=content.id).exists()):
-                    raise DuplicateNotification()
-
-                if (cls.behavior == TriggerBehavior.TRIGGER_ONCE and
-                        Notification.objects.filter(target_user=target_user,
-                                                    trigger_name=cls.trigger_name,
-                                                    datetime_processed__isnull=True).exists()):
-                    raise DuplicateNotification()
-
-                if (cls.behavior == TriggerBehavior.TRIGGER_ONCE_PER_CONTENT and
-                        Notification.objects.filter(
-                            target_user=target_user,
-                            trigger_name=cls.trigger_name,
-                            datetime_processed__isnull=True,
-                            content_type=ContentType.objects.get_for_model(content),
-                            content_id=content.id).exists()):
-                    raise DuplicateNotification()
-
-                if cls.behavior == TriggerBehavior.LAST_ONLY:
-                    waiting_notifications = Notification.objects.filter(
-                        target_user=target_user,
-                        trigger_name=cls.trigger_name,
-                        datetime_processed__isnull=True)
-                    for waiting_notification in waiting_notifications:
-                        waiting_notification.cancel()
-
-            except DuplicateNotification:
-                if not silent:
-                    raise
-                else:
-                    return None
+            if cls.behavior == TriggerBehavior.LAST_ONLY:
+                cls.cancel_pending(target_user=target_user)
 
             if datetime_scheduled is None:
                 datetime_scheduled = timezone.now()
@@ -124,7 +116,162 @@ def message(trigger_name, behavior=None, **kwargs):
                                                        **extra)
             return notification
 
+        def trigger_many(cls, target_users, trigger_user=None,
+                         datetime_scheduled=None, content=None, data=None, batch_size=500):
+            """
+            Trigger a notification to many users at once
+
+            Duplicates are checked against the ledger with one query per chunk of `batch_size` users, and
+            notifications are inserted with `bulk_create`. Unlike `trigger()`, no lock is taken for `LAST_ONLY`.
+
+            :return: list of created notifications
+            """
+
+            if datetime_scheduled is None:
+                datetime_scheduled = timezone.now()
+
+            if cls.behavior not in (TriggerBehavior.DEFAULT, TriggerBehavior.DELETE_AFTER_PROCESSING):
+                # A user should only get one notification
+                target_users = list(dict((target_user.id, target_user) for target_user in target_users).values())
+
+            # Pickle data once for all notifications
+            template = Notification(trigger_name=cls.trigger_name,
+                                    trigger_user=trigger_user,
+                                    datetime_scheduled=datetime_scheduled,
+                                    status=Notification.Status.CREATED)
+            if content is not None:
+                template.content = content
+            if data is not None:
+                template.data = data
+            template.serialize_data()
+
+            notifications = []
+            for chunk in chunked(target_users, batch_size):
+                with transaction.atomic():
+                    target_user_ids = [target_user.id for target_user in chunk]
+
+                    if cls.behavior == TriggerBehavior.LAST_ONLY:
+                        Notification.objects.filter(trigger_name=cls.trigger_name,
+                                                    target_user__in=target_user_ids).cancel()
+
+                    elif cls.behavior in ONCE_BEHAVIORS:
+                        key = NotificationLedger.key(cls.trigger_name, cls.behavior, None,
+                                                     template.content_type_id, template.content_id)
+                        del key['target_user_id']
+                        entries = NotificationLedger.objects.filter(target_user__in=target_user_ids, **key)
+                        if cls.behavior in (TriggerBehavior.TRIGGER_ONCE,
+                                            TriggerBehavior.TRIGGER_ONCE_PER_CONTENT):
+                            entries.filter(NotificationLedger.stale()).delete()
+
+                        duplicates = set(entries.values_list('target_user_id', flat=True))
+                        chunk = [target_user for target_user in chunk if target_user.id not in duplicates]
+
+                    chunk_notifications = [Notification(trigger_name=cls.trigger_name,
+                                                        target_user=target_user,
+                                                        trigger_user=trigger_user,
+                                                        content_type=template.content_type,
+                                                        content_id=template.content_id,
+                                                        data_pickled=template.data_pickled,
+                                                        data_binary=template.data_binary,
+                                                        datetime_scheduled=datetime_scheduled,
+                                                        status=template.status)
+                                           for target_user in chunk]
+                    _bulk_create(chunk_notifications, batch_size)
+
+                    if cls.behavior in ONCE_BEHAVIORS:
+                        chunk_notifications = _record_many(cls, chunk_notifications, batch_size)
+
+                notifications.extend(chunk_notifications)
+
+            _dispatch_on_commit(cls, notifications)
+            return notifications
+
+        def _dispatch_on_commit(cls, notifications):
+            """
+            Enqueue notifications due now once the transaction is committed, instead of waiting for the poller
+            """
+
+            if not cls.kwargs.get('dispatch_on_commit'):
+                return
+
+            now = timezone.now()
+            notification_ids = [notification.pk for notification in notifications
+                                if notification.datetime_scheduled <= now]
+            if not notification_ids:
+                return
+
+            from transmissions.tasks import dispatch
+
+            def dispatch_notifications():
+                try:
+                    dispatch(notification_ids, queue=cls.kwargs.get('queue'))
+                except Exception as e:
+                    # Broker is unavailable: release the lease so that the poller dispatches them
+                    logging.getLogger('django-transmissions').exception(e)
+                    Notification.objects.filter(pk__in=notification_ids, status=Notification.Status.CREATED)\
+                        .update(datetime_lease_expires=None)
+
+            if hasattr(transaction, 'on_commit'):
+                transaction.on_commit(dispatch_notifications)
+            elif not transaction.get_connection().in_atomic_block:
+                dispatch_notifications()
+            # Otherwise notifications are not visible to workers yet, the poller dispatches them
+
+        def _bulk_create(notifications, batch_size):
+            Notification.objects.bulk_create(notifications, batch_size=batch_size)
+
+            # Not every database returns primary keys from bulk inserts
+            missing = dict((notification.uuid, notification) for notification in notifications
+                           if notification.pk is None)
+            if missing:
+                for uuid, notification_id in Notification.objects.filter(uuid__in=list(missing.keys()))\
+                        .values_list('uuid', 'id'):
+                    missing[uuid].pk = notification_id
+
+        def _record_many(cls, notifications, batch_size):
+            entries = [NotificationLedger(notification=notification,
+                                          **NotificationLedger.key(cls.trigger_name, cls.behavior,
+                                                                   notification.target_user_id,
+                                                                   notification.content_type_id,
+                                                                   notification.content_id))
+                       for notification in notifications]
+            try:
+                with transaction.atomic():
+                    NotificationLedger.objects.bulk_create(entries, batch_size=batch_size)
+                return notifications
+            except IntegrityError:
+                pass
+
+            # Notifications were triggered concurrently for some users, record one at a time
+            recorded, duplicates = [], []
+            for notification in notifications:
+                if NotificationLedger.record(notification, cls.behavior):
+                    recorded.append(notification)
+                else:
+                    duplicates.append(notification.pk)
+            Notification.objects.filter(pk__in=duplicates).delete()
+            return recorded
+
+        def cancel_pending(cls, target_user=None, content=None, **filters):
+            """
+            Cancel pending notifications of this message with a single UPDATE
+
+            :param target_user: only cancel notifications to this user
+            :param content: only cancel notifications about this content
+            :param filters: additional `Notification` lookups
+            :return: number of notifications cancelled
+            """
+
+            notifications = Notification.objects.filter(trigger_name=cls.trigger_name, **filters)
+            if target_user is not None:
+                notifications = notifications.filter(target_user=target_user)
+            if content is not None:
+                notifications = notifications.for_content(content)
+            return notifications.cancel()
+
         cls.trigger = classmethod(trigger)
+        cls.trigger_many = classmethod(trigger_many)
+        cls.cancel_pending = classmethod(cancel_pending)
 
         return cls
 
@@ -1,3 +1,6 @@
+import os
+import socket
+
 from six import with_metaclass
 
 
@@ -17,3 +20,20 @@ class EnumDict(with_metaclass(EnumDictType)):
     pass
 
 
+
+
+def chunked(iterable, size):
+    """ Split an iterable into lists of at most `size` items """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def worker_name():
+    """ Identify the current worker process """
+    return '{}:{}'.format(socket.gethostname(), os.getpid())